@@ -0,0 +1,91 @@
+"""Memory and attribute-access cost of Table instances.
+
+Compares the slot-based rows against the previous design, where every
+instance carried a ``_data`` dict and every attribute read went through an
+overridden ``__getattribute__``.
+
+    python benchmarks/bench_instances.py --rows 1000000
+"""
+import argparse
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+if __name__ == "__main__":
+    sys.path.insert(0, str(ROOT))
+
+from finesql import Table, Column  # noqa: E402
+
+
+class Post(Table):
+    title = Column(str)
+    body = Column(str)
+    views = Column(int)
+    published = Column(bool)
+
+
+class DictPost:
+    """The pre-slots Table layout, reduced to what rows and attribute access need."""
+
+    fields = ("id", "body", "published", "title", "views")
+
+    def __init__(self, row):
+        super().__setattr__("_data", dict(zip(DictPost.fields, row)))
+
+    def __getattribute__(self, attr_name):
+        _data = super().__getattribute__("_data")
+
+        if attr_name in _data:
+            return _data[attr_name]
+
+        return super().__getattribute__(attr_name)
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if name in self._data:
+            self._data[name] = value
+
+
+def measure(build, rows):
+    tracemalloc.start()
+    started = time.perf_counter()
+    instances = [build(row) for row in rows]
+    built = time.perf_counter() - started
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    started = time.perf_counter()
+    total = 0
+    for instance in instances:
+        total += instance.views
+        instance.title
+        instance.published
+    read = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for instance in instances:
+        instance.views = 0
+    written = time.perf_counter() - started
+
+    return built, memory, read, written
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    rows = [(number, "body", number % 2, f"title {number}", number) for number in range(args.rows)]
+
+    print(f"{args.rows:,} rows")
+    print(f"{'layout':<8} {'build s':>9} {'MiB':>9} {'B/row':>7} {'3 reads s':>10} {'1 write s':>10}")
+    for name, build in (("dict", DictPost), ("slots", Post._from_row)):
+        built, memory, read, written = measure(build, rows)
+        print(f"{name:<8} {built:>9.3f} {memory / 2 ** 20:>9.1f} {memory // args.rows:>7} {read:>10.3f} {written:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
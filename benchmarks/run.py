@@ -0,0 +1,264 @@
+"""Benchmarks for the ORM hot paths.
+
+Every case runs against tables holding SIZE rows, on ``:memory:`` and on a
+database file, and reports operations per second, SQL statements per
+operation and peak Python memory:
+
+    python benchmarks/run.py --sizes 1k,100k,1M
+    python benchmarks/run.py --save before.json
+    python benchmarks/run.py --compare before.json
+    python benchmarks/run.py --against HEAD~3     # benchmark another commit, then this tree
+
+Cases that need an API the benchmarked finesql doesn't have yet are skipped,
+so older commits can be measured with the current script.
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+if __name__ == "__main__" and "FINESQL_PATH" in os.environ:
+    sys.path.insert(0, os.environ["FINESQL_PATH"])
+elif __name__ == "__main__":
+    sys.path.insert(0, str(ROOT))
+
+from finesql import Database, Table, Column, ForeignKey  # noqa: E402
+
+
+class User(Table):
+    username = Column(str)
+    age = Column(int)
+
+
+class Post(Table):
+    title = Column(str)
+    views = Column(int)
+    author = ForeignKey(User)
+
+
+class Comment(Table):
+    text = Column(str)
+    post = ForeignKey(Post)
+
+
+class Counter:
+    def __init__(self, db):
+        self.count = 0
+        db.conn.set_trace_callback(self)
+
+    def __call__(self, statement):
+        self.count += 1
+
+
+def populate(db, size):
+    for table in (User, Post, Comment):
+        db.create(table)
+
+    # raw executemany keeps the setup independent of the finesql version under test
+    users = max(size // 10, 1)
+    db.conn.executemany("INSERT INTO user (age, username) VALUES (?, ?);",
+                        ((number % 90, f"user{number}") for number in range(users)))
+    db.conn.executemany("INSERT INTO post (author_id, title, views) VALUES (?, ?, ?);",
+                        ((number % users + 1, f"post {number}", number) for number in range(size)))
+    db.conn.executemany("INSERT INTO comment (post_id, text) VALUES (?, ?);",
+                        ((number % size + 1, f"comment {number}") for number in range(size)))
+    db.conn.commit()
+    return users
+
+
+def insert_single(db, size, users):
+    for number in range(1000):
+        db.save(User(username=f"new{number}", age=number % 90))
+    return 1000
+
+
+def insert_bulk(db, size, users):
+    if not hasattr(db, "save_many"):
+        return None
+    db.save_many([User(username=f"bulk{number}", age=number % 90) for number in range(10000)])
+    return 10000
+
+
+def get_by_id(db, size, users):
+    ids = random.Random(1).choices(range(1, users + 1), k=1000)
+    for id in ids:
+        db.get(User, id=id)
+    return len(ids)
+
+
+def get_with_fk_chain(db, size, users):
+    ids = random.Random(2).choices(range(1, size + 1), k=1000)
+    for id in ids:
+        db.get(Comment, id=id)
+    return len(ids)
+
+
+def get_by_field(db, size, users):
+    for number in range(100):
+        db.get_by_field(User, field_name="username", value=f"user{number}")
+    return 100
+
+
+def all_flat(db, size, users):
+    return len(db.all(User))
+
+
+def all_with_fk(db, size, users):
+    return len(db.all(Post))
+
+
+def all_with_fk_chain(db, size, users):
+    return len(db.all(Comment))
+
+
+def columns(db, size, users):
+    if not hasattr(db, "columns"):
+        return None
+    return len(db.columns(Post, ["author", "views"])["views"])
+
+
+def update(db, size, users):
+    ids = random.Random(3).choices(range(1, users + 1), k=1000)
+    for id in ids:
+        user = db.get(User, id=id)
+        user.age += 1
+        db.update(user)
+    return len(ids)
+
+
+CASES = [insert_single, insert_bulk, get_by_id, get_with_fk_chain, get_by_field, all_flat, all_with_fk,
+         all_with_fk_chain, columns, update]
+
+
+def open_database(storage, directory, size):
+    if storage == "memory":
+        return Database(":memory:")
+
+    path = Path(directory) / f"bench-{size}.db"
+    for leftover in Path(directory).glob(f"bench-{size}.db*"):
+        leftover.unlink()
+    return Database(str(path))
+
+
+def run_case(case, storage, size, directory):
+    # fresh tables per case, so writes of one case don't skew the next
+    db = open_database(storage, directory, size)
+    users = populate(db, size)
+
+    started = time.perf_counter()
+    ops = case(db, size, users)
+    elapsed = time.perf_counter() - started
+    db.conn.close()
+    if ops is None:
+        return None
+
+    # statements and memory are measured on a second run, so their hooks don't slow the timed one
+    db = open_database(storage, directory, size)
+    users = populate(db, size)
+    counter = Counter(db)
+    tracemalloc.start()
+    case(db, size, users)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    db.conn.close()
+
+    return {
+        "ops_per_sec": ops / elapsed,
+        "queries_per_op": counter.count / ops,
+        "peak_mib": peak / 2 ** 20,
+    }
+
+
+def parse_size(text):
+    multiplier = {"k": 10 ** 3, "m": 10 ** 6}.get(text[-1].lower(), 1)
+    return int(float(text.rstrip("kKmM")) * multiplier)
+
+
+def benchmark(sizes, storages, cases):
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            for storage in storages:
+                for case in cases:
+                    result = run_case(case, storage, size, directory)
+                    if result is not None:
+                        key = f"{case.__name__}/{storage}/{size}"
+                        results[key] = result
+                        print_row(key, result, None)
+    return results
+
+
+def print_row(key, result, baseline):
+    line = (f"{key:<36} {result['ops_per_sec']:>12,.0f} ops/s {result['queries_per_op']:>9.3g} q/op "
+            f"{result['peak_mib']:>9.1f} MiB")
+    if baseline is not None:
+        change = result["ops_per_sec"] / baseline["ops_per_sec"] - 1
+        line += f"   {change:+7.1%} vs baseline ({baseline['queries_per_op']:.3g} q/op)"
+    print(line, flush=True)
+
+
+def compare(results, baseline):
+    print("\ncompared with the baseline:")
+    for key, result in results.items():
+        if key in baseline:
+            print_row(key, result, baseline[key])
+
+
+def run_against(ref, argv):
+    """Benchmark ``ref`` from a temporary git worktree with this script; returns its results."""
+    with tempfile.TemporaryDirectory() as directory:
+        worktree = Path(directory) / "tree"
+        output = Path(directory) / "results.json"
+        subprocess.run(["git", "worktree", "add", "--detach", str(worktree), ref], cwd=ROOT, check=True,
+                       capture_output=True)
+        try:
+            print(f"== {ref}")
+            env = {**os.environ, "FINESQL_PATH": str(worktree)}
+            subprocess.run([sys.executable, __file__, *argv, "--save", str(output)], env=env, check=True)
+            return json.loads(output.read_text())
+        finally:
+            subprocess.run(["git", "worktree", "remove", "--force", str(worktree)], cwd=ROOT, check=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="1k,100k,1M", help="comma-separated table sizes (default: %(default)s)")
+    parser.add_argument("--storage", default="memory,file", help="memory, file or both (default: %(default)s)")
+    parser.add_argument("--cases", help="comma-separated subset of: " + ", ".join(c.__name__ for c in CASES))
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--against", metavar="GIT_REF", help="benchmark this commit first and compare")
+    args = parser.parse_args()
+
+    cases = CASES
+    if args.cases:
+        wanted = args.cases.split(",")
+        cases = [case for case in CASES if case.__name__ in wanted]
+
+    baseline = None
+    if args.against:
+        argv = ["--sizes", args.sizes, "--storage", args.storage] + (["--cases", args.cases] if args.cases else [])
+        baseline = run_against(args.against, argv)
+        print("== working tree")
+    elif args.compare:
+        baseline = json.loads(Path(args.compare).read_text())
+
+    sizes = [parse_size(size) for size in args.sizes.split(",")]
+    results = benchmark(sizes, args.storage.split(","), cases)
+
+    if args.save:
+        Path(args.save).write_text(json.dumps(results, indent=2))
+    if baseline is not None:
+        compare(results, baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -1 +1,4 @@
-from .orm import Database, Table, Column, ForeignKey
+from .orm import Database, Table, Column, ForeignKey, Index
+from .query import Query
+from .aio import AsyncDatabase
+from .instrumentation import QueryStats
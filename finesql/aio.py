@@ -0,0 +1,81 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from .orm import Database
+
+
+class AsyncDatabase:
+    """Awaitable Database: every call runs on executor threads so the event loop never blocks on SQLite.
+
+    With ``workers=1`` the connection lives on one dedicated thread. More workers use a pooled
+    Database, so that many coroutines can have reads in flight at once.
+    """
+
+    def __init__(self, path, workers=1, **options):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="finesql")
+
+        if workers == 1:
+            # the connection belongs to the thread that opens it
+            self.db = self._executor.submit(Database, path, **options).result()
+        else:
+            options.setdefault("pool_size", workers)
+            self.db = Database(path, **options)
+
+    async def _run(self, method, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(method, *args, **kwargs))
+
+    async def create(self, table):
+        return await self._run(self.db.create, table)
+
+    async def save(self, instance):
+        return await self._run(self.db.save, instance)
+
+    async def save_many(self, instances):
+        return await self._run(self.db.save_many, instances)
+
+    async def upsert(self, instance, conflict_on):
+        return await self._run(self.db.upsert, instance, conflict_on)
+
+    async def upsert_many(self, instances, conflict_on):
+        return await self._run(self.db.upsert_many, instances, conflict_on)
+
+    async def get(self, table, id, **options):
+        return await self._run(self.db.get, table, id, **options)
+
+    async def get_by_field(self, table, field_name=None, value=None, **options):
+        return await self._run(self.db.get_by_field, table, field_name, value, **options)
+
+    async def all(self, table, **options):
+        return await self._run(self.db.all, table, **options)
+
+    async def update(self, instance):
+        return await self._run(self.db.update, instance)
+
+    async def delete(self, table, id):
+        return await self._run(self.db.delete, table, id)
+
+    async def iter(self, table, batch_size=1000, **options):
+        """Async counterpart of Database.iter; each batch is fetched on the executor."""
+        instances = self.db.iter(table, batch_size, **options)
+        try:
+            while True:
+                batch = await self._run(lambda: list(islice(instances, batch_size)))
+                if not batch:
+                    break
+                for instance in batch:
+                    yield instance
+        finally:
+            await self._run(instances.close)
+
+    async def close(self):
+        await self._run(self.db.close)
+        self._executor.shutdown()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
@@ -0,0 +1,165 @@
+import bisect
+import functools
+import logging
+import re
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+logger = logging.getLogger("finesql")
+
+# rowcount is None for SELECTs: their rows are only known once the caller fetches them
+QueryEvent = namedtuple("QueryEvent", ["sql", "params", "rowcount", "duration", "table", "operation"])
+
+TABLE_RE = re.compile(r"\b(?:FROM|INTO|UPDATE|ON|TABLE)\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?(\w+)", re.IGNORECASE)
+EXPLAINABLE = {"SELECT", "INSERT", "UPDATE", "DELETE", "REPLACE", "WITH"}
+
+
+@functools.lru_cache(maxsize=1024)
+def describe(sql):
+    """(table, operation) of a statement, e.g. ``("post", "SELECT")``."""
+    words = sql.split(None, 1)
+    operation = words[0].upper() if words else ""
+    match = TABLE_RE.search(sql)
+    return (match.group(1) if match else None), operation
+
+
+class LatencyHistogram:
+    """Counts of durations per bucket; bounds are upper limits in seconds."""
+
+    BOUNDS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, float("inf"))
+
+    def __init__(self):
+        self.counts = [0] * len(self.BOUNDS)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, duration):
+        self.counts[bisect.bisect_left(self.BOUNDS, duration)] += 1
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the given fraction (0.99 for p99) of the observations."""
+        target = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.BOUNDS, self.counts):
+            seen += count
+            if count and seen >= target:
+                return min(bound, self.max)
+        return 0.0
+
+    def __repr__(self):
+        return f"<LatencyHistogram count={self.count} mean={self.mean * 1000:.3f}ms max={self.max * 1000:.3f}ms>"
+
+
+class QueryStats:
+    """Statement counts and latency histograms per (table, operation); pass it as an ``after`` listener."""
+
+    def __init__(self):
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        key = (event.table, event.operation)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = LatencyHistogram()
+            histogram.observe(event.duration)
+
+    def count(self, table=None, operation=None):
+        return sum(histogram.count for (name, op), histogram in self.histograms.items()
+                   if table in (None, name) and operation in (None, op))
+
+    def reset(self):
+        with self._lock:
+            self.histograms.clear()
+
+    def report(self):
+        lines = [f"{'table':<20} {'operation':<10} {'count':>8} {'mean ms':>9} {'p99 ms':>9} {'max ms':>9}"]
+        for (table, operation), histogram in sorted(self.histograms.items(), key=lambda item: str(item[0])):
+            lines.append(f"{table or '-':<20} {operation:<10} {histogram.count:>8} {histogram.mean * 1000:>9.3f} "
+                         f"{histogram.percentile(0.99) * 1000:>9.3f} {histogram.max * 1000:>9.3f}")
+        return "\n".join(lines)
+
+
+class Instrumentation:
+    """Listeners and slow-query logging around every statement a Database sends."""
+
+    def __init__(self, slow_query_threshold=None):
+        self.before = []
+        self.after = []
+        self.slow_query_threshold = slow_query_threshold
+
+    @property
+    def active(self):
+        return bool(self.before or self.after or self.slow_query_threshold is not None)
+
+    def add_listener(self, before=None, after=None):
+        if before is not None:
+            self.before.append(before)
+        if after is not None:
+            self.after.append(after)
+
+    def remove_listener(self, before=None, after=None):
+        if before is not None:
+            self.before.remove(before)
+        if after is not None:
+            self.after.remove(after)
+
+    def run(self, conn, sql, params, many=False):
+        for callback in self.before:
+            callback(sql, params)
+
+        started = time.perf_counter()
+        cursor = conn.executemany(sql, params) if many else conn.execute(sql, params)
+        duration = time.perf_counter() - started
+
+        table, operation = describe(sql)
+        rowcount = None if operation == "SELECT" else cursor.rowcount
+        event = QueryEvent(sql, params, rowcount, duration, table, operation)
+        for callback in self.after:
+            callback(event)
+
+        if self.slow_query_threshold is not None and duration >= self.slow_query_threshold:
+            self.log_slow_query(conn, event, many)
+
+        return cursor
+
+    @staticmethod
+    def log_slow_query(conn, event, many=False):
+        plan = ""
+        if event.operation in EXPLAINABLE and not many:
+            try:
+                rows = conn.execute(f"EXPLAIN QUERY PLAN {event.sql}", event.params).fetchall()
+                plan = "\n".join(f"  {row[-1]}" for row in rows)
+            except Exception as error:  # the plan is a diagnostic, never worth failing the query over
+                plan = f"  (no plan: {error})"
+
+        logger.warning("slow query (%.1f ms): %s params=%r\n%s", event.duration * 1000, event.sql,
+                       event.params, plan)
+
+    @contextmanager
+    def assert_max_queries(self, limit):
+        statements = []
+
+        def record(event):
+            statements.append(event.sql)
+
+        self.add_listener(after=record)
+        try:
+            yield statements
+        finally:
+            self.remove_listener(after=record)
+
+        if len(statements) > limit:
+            listing = "\n".join(f"  {sql}" for sql in statements)
+            raise AssertionError(f"{len(statements)} queries executed, expected at most {limit}:\n{listing}")
@@ -1,45 +1,839 @@
+import base64
+import functools
 import inspect
+import json
 import sqlite3
+import sys
+import threading
+import time
+from array import array
+from collections import OrderedDict, namedtuple
+from collections.abc import MutableMapping
+from contextlib import contextmanager
 
 from icecream import ic
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .instrumentation import Instrumentation
+from .pool import ConnectionPool, PoolInfo
+from .query import Query, compile_filters, compile_order, resolve_field
+from .writer import BackgroundWriter
+
+# SQLITE_MAX_VARIABLE_NUMBER defaults to 999 before SQLite 3.32.0
+MAX_VARIABLES = 32766 if sqlite3.sqlite_version_info >= (3, 32, 0) else 999
+
+# INSERT ... ON CONFLICT DO UPDATE needs SQLite 3.24.0, its RETURNING clause 3.35.0
+UPSERT = sqlite3.sqlite_version_info >= (3, 24, 0)
+RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
+
+class Page(namedtuple("Page", ["items", "next_cursor"])):
+    """One page of Database.paginate; pass ``next_cursor`` as ``after`` to get the next one."""
+
+    __slots__ = ()
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+
+# PRAGMAs applied to every connection, by Database(profile=...)
+PROFILES = {
+    "default": {},
+    # WAL lets readers run beside the writer; NORMAL syncs at checkpoints instead of every commit
+    "throughput": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "mmap_size": 256 * 2 ** 20,
+        "cache_size": -64 * 2 ** 10,  # negative: KiB rather than pages
+        "temp_store": "MEMORY",
+        "busy_timeout": 5000,
+    },
+    "safe": {
+        "journal_mode": "WAL",
+        "synchronous": "FULL",
+        "busy_timeout": 5000,
+    },
+}
+
+# array typecodes for Database.columns; other SQL types are collected in lists
+TYPECODES = {"INTEGER": "q", "REAL": "d"}
+NUMPY_TYPES = {"q": "int64", "d": "float64"}
+
+SETTINGS = ("journal_mode", "synchronous", "mmap_size", "cache_size", "temp_store", "busy_timeout", "page_size")
+SYNCHRONOUS = {0: "OFF", 1: "NORMAL", 2: "FULL", 3: "EXTRA"}
+TEMP_STORE = {0: "DEFAULT", 1: "FILE", 2: "MEMORY"}
+
+
+def reads(method):
+    """Run the method on a pooled reader connection unless the thread already holds one."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self._pool is None:
+            return method(self, *args, **kwargs)
+        with self._reader():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def writes(method):
+    """Run the method on the writer connection, one thread at a time."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self._pool is None:
+            return method(self, *args, **kwargs)
+        with self._writer():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class ThreadState(threading.local):
+    conn = None  # connection the thread is currently working on
+    identity = None  # (table, id) -> instance while a session() is open
+
 
 class Database:
-    def __init__(self, path):
-        self.conn = sqlite3.Connection(path)
+    def __init__(self, path, autocommit=True, cached_statements=128, cache_size=0, pool_size=None,
+                 pool_timeout=None, profile="default", pragmas=None, slow_query_threshold=None):
+        if profile not in PROFILES:
+            raise ValueError(f"Unknown profile {profile!r}, expected one of {', '.join(PROFILES)}")
+
+        self.path = path
+        self.autocommit = autocommit
+        self.pragmas = {**PROFILES[profile], **(pragmas or {})}
+        self._depth = 0  # open transaction() blocks
+        self._state = ThreadState()
+        self._lock = threading.Lock()  # guards the caches and counters below
+        self.instrumentation = Instrumentation(slow_query_threshold)
+
+        self._pool = None
+        if pool_size is None:
+            self.conn = self._connect(cached_statements, check_same_thread=True)
+        else:
+            # every connection would get its own empty database
+            if path == ":memory:" or str(path).startswith("file::memory:"):
+                raise ValueError("A connection pool needs a database file, not ':memory:'")
+            # readers would not see the rows the writer connection has not committed yet
+            if not autocommit:
+                raise ValueError("A connection pool needs autocommit=True")
+
+            # readers only run beside the writer in WAL mode
+            self.pragmas.setdefault("journal_mode", "WAL")
+            self.conn = self._connect(cached_statements)
+            self._pool = ConnectionPool(lambda: self._connect(cached_statements), pool_size, pool_timeout)
+            self._write_lock = threading.RLock()
+            # thread id -> [reader, open streams]: readers held by iter()/query streams across their yields
+            self._held = {}
+            self._writer_checkouts = 0
+            self._writer_wait_time = 0.0
+
+        # LRU of rows by (table, id) for get() and foreign keys; 0 disables it
+        self._rows = OrderedDict()
+        self._row_hits = 0
+        self._row_misses = 0
+        self._cache_size = cache_size
+
+        # mirror of the connection's LRU statement cache, to count its hits and misses
+        self._statements = OrderedDict()
+        self._statement_hits = 0
+        self._statement_misses = 0
+        self._cached_statements = cached_statements
+
+    def _connect(self, cached_statements, check_same_thread=False):
+        conn = sqlite3.Connection(self.path, cached_statements=cached_statements,
+                                  check_same_thread=check_same_thread)
+        for name, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {name} = {value};")
+        return conn
+
+    @reads
+    def settings(self):
+        """Effective values of the performance PRAGMAs on this database's connections."""
+        conn = self._state.conn or self.conn
+        settings = {name: conn.execute(f"PRAGMA {name};").fetchone()[0] for name in SETTINGS}
+        settings["synchronous"] = SYNCHRONOUS.get(settings["synchronous"], settings["synchronous"])
+        settings["temp_store"] = TEMP_STORE.get(settings["temp_store"], settings["temp_store"])
+        settings["journal_mode"] = settings["journal_mode"].upper()
+        return settings
+
+    @property
+    def _identity(self):
+        return self._state.identity
+
+    @contextmanager
+    def _reader(self):
+        state = self._state
+        if self._pool is None or state.conn is not None:
+            yield state.conn or self.conn
+            return
+
+        held = self._held.get(threading.get_ident())
+        if held is not None:
+            # an open stream on this thread already holds a reader; a second one could exhaust the pool
+            state.conn = held[0]
+            try:
+                yield held[0]
+            finally:
+                state.conn = None
+            return
+
+        conn = state.conn = self._pool.acquire()
+        try:
+            yield conn
+        finally:
+            state.conn = None
+            self._pool.release(conn)
+
+    def _hold(self):
+        """Reader for a stream, shared with the other streams and reads of the calling thread."""
+        thread = threading.get_ident()
+        with self._lock:
+            held = self._held.get(thread)
+            if held is not None:
+                held[1] += 1
+                return thread, held[0]
+
+        # only this thread adds its own entry, so acquiring outside the lock can't race another stream
+        conn = self._pool.acquire()
+        with self._lock:
+            self._held[thread] = [conn, 1]
+        return thread, conn
+
+    def _unhold(self, thread):
+        with self._lock:
+            held = self._held[thread]
+            held[1] -= 1
+            if held[1]:
+                return
+            del self._held[thread]
+        self._pool.release(held[0])
+
+    @contextmanager
+    def _writer(self):
+        state = self._state
+        if self._pool is None or state.conn is self.conn:
+            yield self.conn
+            return
+
+        started = time.perf_counter()
+        with self._write_lock:
+            with self._lock:
+                self._writer_checkouts += 1
+                self._writer_wait_time += time.perf_counter() - started
+
+            previous, state.conn = state.conn, self.conn
+            try:
+                yield self.conn
+            finally:
+                state.conn = previous
+
+    def writer(self, max_batch_size=500, max_latency=0.01):
+        """BackgroundWriter committing save/update/delete calls in batches from one thread."""
+        return BackgroundWriter(self, max_batch_size, max_latency)
+
+    def pool_info(self):
+        if self._pool is None:
+            return None
+
+        pool = self._pool
+        return PoolInfo(pool.size, pool.open, pool.idle, pool.checkouts, pool.waits, pool.wait_time,
+                        self._writer_checkouts, self._writer_wait_time)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+        self.conn.close()
+
+    def _track(self, query):
+        if self._pool is not None:
+            return  # each pooled connection has its own cache, which one mirror can't follow
+
+        with self._lock:
+            if query in self._statements:
+                self._statements.move_to_end(query)
+                self._statement_hits += 1
+            else:
+                self._statement_misses += 1
+                self._statements[query] = None
+                if len(self._statements) > self._cached_statements:
+                    self._statements.popitem(last=False)
+
+    def _execute(self, query, params=(), conn=None):
+        self._track(query)
+        conn = conn or self._state.conn or self.conn
+        if self.instrumentation.active:
+            return self.instrumentation.run(conn, query, params)
+        return conn.execute(query, params)
+
+    def _executemany(self, query, params):
+        self._track(query)
+        conn = self._state.conn or self.conn
+        if self.instrumentation.active:
+            return self.instrumentation.run(conn, query, params, many=True)
+        return conn.executemany(query, params)
+
+    def add_listener(self, before=None, after=None):
+        """Call ``before(sql, params)`` ahead of every statement and ``after(event)`` once it ran."""
+        self.instrumentation.add_listener(before, after)
+
+    def remove_listener(self, before=None, after=None):
+        self.instrumentation.remove_listener(before, after)
 
     @property
+    def slow_query_threshold(self):
+        return self.instrumentation.slow_query_threshold
+
+    @slow_query_threshold.setter
+    def slow_query_threshold(self, seconds):
+        self.instrumentation.slow_query_threshold = seconds
+
+    def assert_max_queries(self, limit):
+        """Context manager failing with AssertionError when its block runs more than ``limit`` statements."""
+        return self.instrumentation.assert_max_queries(limit)
+
+    def statement_cache_info(self):
+        """Hits and misses of the connection's statement cache; None with a pool, whose connections each keep one."""
+        if self._pool is not None:
+            return None
+        return CacheInfo(self._statement_hits, self._statement_misses, self._cached_statements, len(self._statements))
+
+    def cache_info(self):
+        return CacheInfo(self._row_hits, self._row_misses, self._cache_size, len(self._rows))
+
+    def clear_cache(self):
+        with self._lock:
+            self._rows.clear()
+
+    def _cached_rows(self, table, ids):
+        found = {}
+        with self._lock:
+            for id in ids:
+                row = self._rows.get((table, id))
+                if row is None:
+                    self._row_misses += 1
+                else:
+                    self._rows.move_to_end((table, id))
+                    self._row_hits += 1
+                    found[id] = row
+        return found
+
+    def _cache_rows(self, table, rows):
+        with self._lock:
+            for row in rows:
+                self._rows[(table, row[0])] = row
+                self._rows.move_to_end((table, row[0]))
+            while len(self._rows) > self._cache_size:
+                self._rows.popitem(last=False)
+
+    def _uncache(self, table, id):
+        with self._lock:
+            self._rows.pop((table, id), None)
+
+    def _forget_table(self, table):
+        with self._lock:
+            for key in [key for key in self._rows if key[0] is table]:
+                del self._rows[key]
+        if self._identity is not None:
+            for key in [key for key in self._identity if key[0] is table]:
+                del self._identity[key]
+
+    def _forget(self, table, id):
+        self._uncache(table, id)
+        if self._identity is not None:
+            self._identity.pop((table, id), None)
+
+    def _remember(self, instance):
+        table = type(instance)
+        if self._cache_size:
+            self._cache_rows(table, [(instance.id, *table._schema.values(instance._values))])
+        if self._identity is not None:
+            self._identity[(table, instance.id)] = instance
+
+    @contextmanager
+    def session(self):
+        """Within the block every row maps to one instance; nested sessions share the outer map."""
+        if self._state.identity is not None:
+            yield self
+            return
+
+        self._state.identity = {}
+        try:
+            yield self
+        finally:
+            self._state.identity = None
+
+    @property
+    @reads
     def tables(self):
         SELECT_TABLE_SQL = "SELECT name FROM sqlite_master WHERE type = 'table' ;"
-        return [row[0] for row in self.conn.execute(SELECT_TABLE_SQL).fetchall()]
+        return [row[0] for row in self._execute(SELECT_TABLE_SQL).fetchall()]
+
+    @writes
+    def commit(self):
+        self.conn.commit()
 
+    @writes
+    def rollback(self):
+        self.conn.rollback()
+        self.clear_cache()
+
+    def _commit(self):
+        # writes inside transaction() or with autocommit=False wait for an explicit COMMIT
+        if self.autocommit and not self._depth:
+            self.conn.commit()
+
+    @contextmanager
+    def _autocommitted(self):
+        """Commit the block's writes in autocommit mode, or roll them back when a statement or the COMMIT fails."""
+        try:
+            yield
+            self._commit()
+        except BaseException:
+            # otherwise sqlite3's implicit transaction stays open and swallows the next writes
+            if self.autocommit and not self._depth and self.conn.in_transaction:
+                self.conn.rollback()
+            raise
+
+    @contextmanager
+    def transaction(self):
+        with self._writer():
+            with self._transaction():
+                yield self
+
+    @contextmanager
+    def _transaction(self):
+        savepoint = None
+        if self.autocommit and not self._depth:
+            if self.conn.in_transaction:
+                # a stray implicit transaction, e.g. from a failed COMMIT: its writes were reported as failed
+                self.conn.rollback()
+                self.clear_cache()
+            self._execute("BEGIN")
+        else:
+            if not self.conn.in_transaction:
+                # with autocommit=False the transaction stays open for commit()
+                self._execute("BEGIN")
+            savepoint = f"finesql_{self._depth}"
+            self._execute(f"SAVEPOINT {savepoint}")
+
+        self._depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._depth -= 1
+            if savepoint is None:
+                self.conn.rollback()
+            else:
+                self._execute(f"ROLLBACK TO {savepoint}")
+                self._execute(f"RELEASE {savepoint}")
+            # rows cached inside the block may no longer exist
+            self.clear_cache()
+            raise
+        else:
+            self._depth -= 1
+            if savepoint is None:
+                try:
+                    self.conn.commit()
+                except BaseException:
+                    # e.g. "database is locked": leave no transaction open for the next block to nest in
+                    self.conn.rollback()
+                    self.clear_cache()
+                    raise
+            else:
+                self._execute(f"RELEASE {savepoint}")
+
+    @writes
     def create(self, table):
-        self.conn.execute(table._get_create_sql())
+        schema = table._schema
+        self._execute(table._get_create_sql())
+        for query in schema.index_sql:
+            self._execute(query)
+
+        if schema.search_sql:
+            exists = self._execute("SELECT 1 FROM sqlite_master WHERE name = ?;", (f"{schema.name}_fts",)).fetchone()
+            for query in schema.search_sql:
+                self._execute(query)
+            if not exists:
+                # index the rows written before the table was searchable
+                self._execute(f"INSERT INTO {schema.name}_fts ({schema.name}_fts) VALUES ('rebuild');")
+                self._commit()
+
+    @writes
+    def analyze(self, table=None):
+        """Refresh the statistics the query planner uses to pick indexes."""
+        if table is None:
+            self._execute("ANALYZE;")
+        else:
+            self._execute(f"ANALYZE {table._schema.name};")
 
+    @writes
     def save(self, instance):
         query, values = instance._get_insert_sql()
-        curser = self.conn.execute(query, values)
-        self.conn.commit()
-        instance._data["id"] = curser.lastrowid
-
-    def all(self, table):
-        query, fields = table._get_select_all_sql()
-
-        result = []
-        for row in self.conn.execute(query).fetchall():
-            instance = table()
-            for field, value in zip(fields, row):
-                if field.endswith("_id"):
-                    field = field[:-3]
-                    fk = getattr(table, field)
-                    value = self.get(fk.table, id=value)
-                setattr(instance, field, value)
-
-            result.append(instance)
+        with self._autocommitted():
+            curser = self._execute(query, values)
+        instance.id = curser.lastrowid
+        instance._dirty = 0
+        self._remember(instance)
+
+    def save_many(self, instances):
+        groups = {}
+        for instance in instances:
+            groups.setdefault(type(instance), []).append(instance)
+
+        with self.transaction():
+            # parents first, so children read their ids when the INSERT values are built
+            for table in self._insert_order(groups):
+                batch = groups[table]
+                self._executemany(table._schema.insert_sql, [instance._get_insert_sql()[1] for instance in batch])
+
+                # inside one write transaction AUTOINCREMENT hands out consecutive ids
+                last_id = self._execute("SELECT last_insert_rowid();").fetchone()[0]
+                for id, instance in enumerate(batch, start=last_id - len(batch) + 1):
+                    instance.id = id
+                    instance._dirty = 0
+                    self._remember(instance)
+
+    @writes
+    def upsert(self, instance, conflict_on):
+        """Insert the instance, or update the row it collides with on the ``conflict_on`` unique fields."""
+        schema = type(instance)._schema
+        conflict_on = tuple(conflict_on)
+        query, positions = schema.upsert_sql(conflict_on, RETURNING)
+        values = instance._get_insert_sql()[1]
+        key = [values[position] for position in positions]
+        with self._autocommitted():
+            cursor = self._execute(query, values)
+            if RETURNING:
+                id, = cursor.fetchone()
+            elif None in key:
+                id = cursor.lastrowid  # a NULL key never conflicts, so the row was inserted
+            else:
+                id, *_ = self._execute(schema.select_by_keys_sql(conflict_on, 1), key).fetchone()
+
+        instance.id = id
+        instance._dirty = 0
+        self._remember(instance)
+        return id
+
+    @writes
+    def upsert_many(self, instances, conflict_on):
+        """upsert() for many instances of one table: one executemany, then the ids looked up by their keys."""
+        instances = list(instances)
+        if not instances:
+            return
+
+        table = type(instances[0])
+        if any(type(instance) is not table for instance in instances):
+            raise ValueError("upsert_many takes instances of a single table")
+
+        schema = table._schema
+        query, positions = schema.upsert_sql(tuple(conflict_on), returning=False)
+        values = [instance._get_insert_sql()[1] for instance in instances]
+        keys = [tuple(row[position] for position in positions) for row in values]
+        # NULLs never conflict in a UNIQUE index, and can't be matched to read the ids back
+        if any(None in key for key in keys):
+            raise ValueError(f"upsert_many needs a value for every conflict_on field ({', '.join(conflict_on)})")
+
+        with self.transaction():
+            self._executemany(query, values)
+
+            ids = {}
+            unique = list(dict.fromkeys(keys))
+            size = MAX_VARIABLES // len(positions)
+            for start in range(0, len(unique), size):
+                chunk = unique[start:start + size]
+                padded = min(1 << (len(chunk) - 1).bit_length(), size)
+                chunk += chunk[-1:] * (padded - len(chunk))
+                lookup = schema.select_by_keys_sql(tuple(conflict_on), padded)
+                for id, *key in self._execute(lookup, [value for key in chunk for value in key]):
+                    ids[tuple(key)] = id
+
+            for instance, key in zip(instances, keys):
+                instance.id = ids[key]
+                instance._dirty = 0
+                self._remember(instance)
+
+    @staticmethod
+    def _insert_order(tables):
+        ordered = []
+        seen = set()
+
+        def visit(table):
+            if table in seen:
+                return
+            seen.add(table)
+            for _, fk in table._schema.foreign_keys:
+                if fk.table in tables:
+                    visit(fk.table)
+            ordered.append(table)
+
+        for table in tables:
+            visit(table)
+
+        return ordered
+
+    @reads
+    def all(self, table, eager=True, select_related=None, lazy=False, prefetch_related=None):
+        query = self._select_all_sql(table, select_related)
+
+        result = self._load(table, self._execute(query).fetchall(), eager, select_related, lazy)
+        for instance in result:
             instance._repr_mode = "all"  # 👈 mark for repr
+        if prefetch_related:
+            self._prefetch(table, result, prefetch_related, eager, lazy)
 
         return result
 
+    def iter(self, table, batch_size=1000, eager=True, select_related=None, field_name=None, value=None,
+             lazy=False, prefetch_related=None):
+        """Yield instances lazily, ``batch_size`` rows (and their foreign keys) at a time."""
+        if field_name is None and value is None:
+            query, params = self._select_all_sql(table, select_related), ()
+        elif field_name is not None and value is not None:
+            query, params = self._select_by_field_sql(table, field_name, value, select_related)
+        else:
+            raise ValueError("Either 'field_name' and 'value' must be provided.")
+
+        yield from self._stream(table, query, params, batch_size, eager, select_related, lazy, prefetch_related)
+
+    def _stream(self, table, query, params, batch_size, eager=True, select_related=None, lazy=False,
+                prefetch_related=None):
+        # the cursor keeps its connection for the whole iteration, not only between yields
+        state = self._state
+        owned = self._pool is not None and state.conn is None
+        if owned:
+            # released by the thread id it was taken for: an async iter may resume on another thread
+            thread, conn = self._hold()
+        else:
+            conn = state.conn or self.conn
+
+        try:
+            cursor = self._execute(query, params, conn)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+
+                previous, state.conn = state.conn, conn
+                try:
+                    instances = self._load(table, rows, eager, select_related, lazy)
+                    if prefetch_related:
+                        self._prefetch(table, instances, prefetch_related, eager, lazy)
+                finally:
+                    state.conn = previous
+
+                for instance in instances:
+                    instance._repr_mode = "all"  # 👈 mark for repr
+                    yield instance
+        finally:
+            if owned:
+                self._unhold(thread)
+
+    @reads
+    def columns(self, table, fields=None, where=None, batch_size=10000):
+        """Column values of every matching row as arrays, without building instances.
+
+        Returns ``{field: values}``: ``array("q")`` for INTEGER columns and foreign keys, ``array("d")`` for
+        REAL, lists for TEXT and BLOB or when a column holds NULL, and NumPy arrays instead when it is
+        installed. ``where`` takes the same ``field__lookup`` filters as ``query().filter``.
+        """
+        schema = table._schema
+        fields = list(fields or schema.attrs)
+        names = [resolve_field(schema, name) for name in fields]
+        query = f"SELECT {', '.join(names)} FROM {schema.name}"
+        clauses, params = compile_filters(schema, where or {})
+        if clauses:
+            query += f" WHERE {' AND '.join(clauses)}"
+
+        typecodes = [schema.typecodes[schema.fields.index(name)] for name in names]
+        values = [array(code) if code else [] for code in typecodes]
+
+        cursor = self._execute(query + ";", params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for index, column in enumerate(zip(*rows)):
+                filled = len(values[index])
+                try:
+                    values[index].extend(column)
+                except TypeError:  # NULL in a typed column; extend() may have appended part of the batch
+                    values[index] = list(values[index][:filled])
+                    values[index].extend(column)
+
+        if numpy is not None:
+            values = [numpy.frombuffer(column, NUMPY_TYPES[column.typecode]) if isinstance(column, array)
+                      else numpy.array(column, dtype=object) for column in values]
+
+        return dict(zip(fields, values))
+
+    @reads
+    def _scalar(self, query, params=()):
+        return self._execute(query, params).fetchone()[0]
+
+    @reads
+    def _aggregate(self, table, expression, filters, group_by=None):
+        schema = table._schema
+        clauses, params = compile_filters(schema, filters)
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        if group_by is None:
+            return self._execute(f"SELECT {expression} FROM {schema.name}{where};", params).fetchone()[0]
+
+        key = resolve_field(schema, group_by)
+        query = f"SELECT {key}, {expression} FROM {schema.name}{where} GROUP BY {key} ORDER BY {key};"
+        return dict(self._execute(query, params).fetchall())
+
+    def count(self, table, group_by=None, **filters):
+        """Number of matching rows, or ``{value: count}`` per value of the ``group_by`` field."""
+        return self._aggregate(table, "COUNT(*)", filters, group_by)
+
+    def exists(self, table, **filters):
+        clauses, params = compile_filters(table._schema, filters)
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        return bool(self._scalar(f"SELECT EXISTS (SELECT 1 FROM {table._schema.name}{where});", params))
+
+    def sum(self, table, field, group_by=None, **filters):
+        return self._aggregate(table, f"SUM({resolve_field(table._schema, field)})", filters, group_by)
+
+    def min(self, table, field, group_by=None, **filters):
+        return self._aggregate(table, f"MIN({resolve_field(table._schema, field)})", filters, group_by)
+
+    def max(self, table, field, group_by=None, **filters):
+        return self._aggregate(table, f"MAX({resolve_field(table._schema, field)})", filters, group_by)
+
+    def avg(self, table, field, group_by=None, **filters):
+        return self._aggregate(table, f"AVG({resolve_field(table._schema, field)})", filters, group_by)
+
+    @reads
+    def paginate(self, table, order_by="id", after=None, page_size=100, eager=True, select_related=None,
+                 lazy=False, **filters):
+        """A page of rows ordered by ``order_by`` ("-field" for descending), starting after the ``after`` cursor.
+
+        Pages are found with ``WHERE (field, id) > (?, ?)`` on the last row seen instead of OFFSET, so every
+        page costs the same. NULLs sort first in ascending order and last in descending order, as in SQLite.
+        """
+        schema = table._schema
+        alias = "t0" if select_related else None
+        prefix = f"{alias}." if alias else ""
+        field = resolve_field(schema, order_by.lstrip("-"))
+        descending = order_by.startswith("-")
+        keys = ["id"] if field == "id" else [field, "id"]
+
+        clauses, params = compile_filters(schema, filters, alias)
+        if after is not None:
+            cursor_order, values = self._decode_cursor(after)
+            if cursor_order != order_by or len(values) != len(keys):
+                raise ValueError(f"Cursor was made for order_by={cursor_order!r}, not {order_by!r}")
+            clauses.append(self._after_clause(prefix + field, prefix + "id", descending, values[0] is None))
+            params += values[-1:] if values[0] is None else values
+
+        query = schema.joined(select_related)[0] if select_related else schema.select_sql
+        if clauses:
+            query += f" WHERE {' AND '.join(clauses)}"
+        direction = "-" if descending else ""
+        query += f" ORDER BY {', '.join(compile_order(schema, [direction + key for key in keys], alias))} LIMIT ?;"
+
+        # one row past the page tells whether another page follows
+        rows = self._execute(query, params + [page_size + 1]).fetchall()
+        next_cursor = None
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            last = rows[-1]
+            next_cursor = self._encode_cursor(order_by, [last[schema.fields.index(key)] for key in keys])
+
+        return Page(self._load(table, rows, eager, select_related, lazy), next_cursor)
+
+    @staticmethod
+    def _after_clause(column, id, descending, null):
+        """WHERE clause for the rows after a cursor; NULL compares as neither less nor greater than a value."""
+        if column == id:
+            return f"{id} {'<' if descending else '>'} ?"
+        if null:
+            # the NULLs come first ascending, then every value; descending they come last
+            if descending:
+                return f"({column} IS NULL AND {id} < ?)"
+            return f"(({column} IS NULL AND {id} > ?) OR {column} IS NOT NULL)"
+        if descending:
+            return f"(({column}, {id}) < (?, ?) OR {column} IS NULL)"
+        return f"({column}, {id}) > (?, ?)"
+
+    @staticmethod
+    def _encode_cursor(order_by, values):
+        # JSON has no bytes: BLOB sort values travel as {"b": base64}
+        values = [{"b": base64.b64encode(value).decode()} if isinstance(value, bytes) else value for value in values]
+        text = json.dumps([order_by, values], separators=(",", ":"))
+        return base64.urlsafe_b64encode(text.encode()).decode().rstrip("=")
+
+    @staticmethod
+    def _decode_cursor(cursor):
+        try:
+            order_by, values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+            values = [base64.b64decode(value["b"]) if isinstance(value, dict) else value for value in values]
+        except (ValueError, TypeError, KeyError):
+            raise ValueError(f"Malformed pagination cursor {cursor!r}") from None
+        return order_by, values
+
+    def query(self, table, eager=True, select_related=None, lazy=False, prefetch_related=None):
+        return Query(self, table, eager, select_related, lazy, prefetch_related)
+
+    @staticmethod
+    def _select_all_sql(table, select_related):
+        if select_related:
+            return table._schema.joined(select_related)[0] + ";"
+
+        query, fields = table._get_select_all_sql()
+        return query
+
+    @staticmethod
+    def _select_by_field_sql(table, field_name, value, select_related, match="contains"):
+        if match == "contains":
+            if select_related:
+                return table._schema.joined(select_related)[0] + f" WHERE t0.{field_name} LIKE ?;", (f"%{value}%",)
+
+            query, fields = table._get_select_by_field_sql(field_name=field_name, value=value)
+            return query, (f"%{value}%",)
+
+        schema = table._schema
+        field = ("t0." if select_related else "") + resolve_field(schema, field_name)
+        query = schema.joined(select_related)[0] if select_related else schema.select_sql
+        if match == "exact":
+            return f"{query} WHERE {field} = ?;", (value,)
+        if match == "prefix":
+            if not isinstance(value, str):
+                raise ValueError(f"match='prefix' needs a str value, not {type(value).__name__}")
+
+            # a range instead of LIKE 'value%', so an index on the field can serve it; the bound is the
+            # smallest string above every match, which has no successor once only U+10FFFF remains
+            stem = value.rstrip(chr(sys.maxunicode))
+            if not stem:
+                return f"{query} WHERE {field} >= ?;", (value,)
+            return f"{query} WHERE {field} >= ? AND {field} < ?;", (value, stem[:-1] + chr(ord(stem[-1]) + 1))
+
+        raise ValueError(f"Unknown match {match!r}, expected 'contains', 'exact' or 'prefix'")
+
+    @reads
+    def search(self, table, field, query, limit=20, eager=True, select_related=None, lazy=False):
+        """Rows whose searchable ``field`` (or any searchable field, for None) match an FTS5 query, best first."""
+        schema = table._schema
+        if not schema.searchable:
+            raise ValueError(f"{table.__name__} has no searchable columns")
+        if field is not None and field not in schema.searchable:
+            raise ValueError(f"{table.__name__}.{field} is not searchable")
+
+        fts = f"{schema.name}_fts"
+        target = f"{fts}.{field}" if field is not None else fts
+        sql = (f"{schema.joined(select_related or ())[0]} JOIN {fts} ON {fts}.rowid = t0.id "
+               f"WHERE {target} MATCH ? ORDER BY rank LIMIT ?;")
+        rows = self._execute(sql, (query, limit)).fetchall()
+        return self._load(table, rows, eager, select_related, lazy)
+
+    @reads
     def get_user(self, table, field_name=None, value=None, return_fields=None):
         if field_name is None and value is None:
             raise ValueError("Either 'field_name' and 'value' must be provided.")
@@ -47,192 +841,535 @@ class Database:
         query = table._get_select_by_user_sql(field_name=field_name, return_fields=return_fields)
         params = (value,)
 
-        cursor = self.conn.execute(query, params)
+        cursor = self._execute(query, params)
         row = cursor.fetchone()
         columns = [desc[0] for desc in cursor.description]
 
         return dict(zip(columns, row))
 
-    def get_by_field(self, table, field_name=None, value=None):
+    @reads
+    def get_by_field(self, table, field_name=None, value=None, eager=True, select_related=None, lazy=False,
+                     match="contains"):
 
         if field_name is not None and value is not None:
-            query, fields = table._get_select_by_field_sql(field_name=field_name, value=value)
-            params = (f"%{value}%",)
+            query, params = self._select_by_field_sql(table, field_name, value, select_related, match)
         else:
             raise ValueError("Either 'field_name' and 'value' must be provided.")
 
-        row = self.conn.execute(query, params).fetchone()
+        row = self._execute(query, params).fetchone()
 
         if row is None:
             raise Exception(f"{table.__name__} instance not found")
 
-        instance = table()
-
-        for field, value in zip(fields, row):
-            if field.endswith("_id"):
-                field = field[:-3]
-                fk = getattr(table, field)
-                value = self.get(fk.table, id=value)
-
-            setattr(instance, field, value)
+        instance, = self._load(table, [row], eager, select_related, lazy)
 
         return instance
 
-    def get(self, table, id):
-        query, fields = table._get_select_by_id_sql(id=id)
-        row = self.conn.execute(query).fetchone()
+    @reads
+    def get(self, table, id, eager=True, select_related=None, lazy=False):
+        if self._identity is not None and (table, id) in self._identity:
+            return self._identity[(table, id)]
+
+        row = None
+        if select_related:
+            query = table._schema.joined(select_related)[0] + " WHERE t0.id = ?;"
+        else:
+            query, fields = table._get_select_by_id_sql()
+            if self._cache_size:
+                row = self._cached_rows(table, [id]).get(id)
 
         if row is None:
-            raise Exception(f"{table.__name__} instance with {id} does not exist")
-
-        instance = table()
-        for field, value in zip(fields, row):
-            if field.endswith("_id"):
-                field = field[:-3]
-                fk = getattr(table, field)
-                value = self.get(fk.table, id=value)
-            setattr(instance, field, value)
+            row = self._execute(query, (id,)).fetchone()
+
+            if row is None:
+                raise Exception(f"{table.__name__} instance with {id} does not exist")
+
+            if self._cache_size and not select_related:
+                self._cache_rows(table, [row])
+
+        instance, = self._load(table, [row], eager, select_related, lazy)
         instance._repr_mode = "get"  # 👈 mark for repr
 
         return instance
 
+    def _load(self, table, rows, eager=True, select_related=None, lazy=False):
+        """Build instances from fetched rows and resolve their foreign keys."""
+        if not select_related:
+            return self._build(table, rows, eager, lazy=lazy)
+
+        _, joins = table._schema.joined(select_related)
+        width = len(table._schema.fields)
+        instances = self._build(table, [row[:width] for row in rows], eager, skip=select_related, lazy=lazy)
+
+        for name, target, start, end in joins:
+            index = table._schema.positions[name]
+            related = {row[start]: row[start:end] for row in rows if row[start] is not None}
+            objects = dict(zip(related, self._build(target, list(related.values()), eager)))
+            for instance in objects.values():
+                instance._repr_mode = "get"
+            for instance, row in zip(instances, rows):
+                instance._values[index] = objects.get(row[start])
+
+        return instances
+
+    def _build(self, table, rows, eager=True, skip=(), lazy=False):
+        if self._identity is None:
+            instances = [table._from_row(row) for row in rows]
+        else:
+            # rows already in the session keep their instance, only new ones need foreign keys
+            known = self._identity
+            result = []
+            instances = []
+            for row in rows:
+                instance = known.get((table, row[0]))
+                if instance is None:
+                    instance = known[(table, row[0])] = table._from_row(row)
+                    instances.append(instance)
+                result.append(instance)
+
+            self._resolve(table, instances, eager, skip, lazy)
+            return result
+
+        self._resolve(table, instances, eager, skip, lazy)
+        return instances
+
+    def _resolve(self, table, instances, eager=True, skip=(), lazy=False):
+        schema = table._schema
+        foreign_keys = []
+        for name, fk in schema.foreign_keys:
+            if name in skip:
+                continue
+
+            index = schema.positions[name]
+            if not (lazy or fk.lazy):
+                foreign_keys.append((index, fk))
+                continue
+
+            for instance in instances:
+                value = instance._values[index]
+                if value is not None:
+                    instance._values[index] = LazyReference(self, fk.table, value)
+
+        if not eager:
+            for instance in instances:
+                for index, fk in foreign_keys:
+                    value = instance._values[index]
+                    if value is not None:
+                        instance._values[index] = self.get(fk.table, id=value, eager=False)
+            return
+
+        # one IN (...) query per referenced table, however many rows point at it
+        wanted = {}
+        for index, fk in foreign_keys:
+            ids = wanted.setdefault(fk.table, set())
+            ids.update(instance._values[index] for instance in instances)
+            ids.discard(None)
+
+        loaded = {target: self._get_many(target, ids) for target, ids in wanted.items()}
+
+        for index, fk in foreign_keys:
+            objects = loaded[fk.table]
+            for instance in instances:
+                value = instance._values[index]
+                if value is not None:
+                    instance._values[index] = objects.get(value)
+
+    def _get_many(self, table, ids):
+        """Load rows by id in chunks that fit SQLite's variable limit, keyed by id."""
+        found = {}
+        if self._identity is not None:
+            found = {id: self._identity[(table, id)] for id in ids if (table, id) in self._identity}
+            ids = [id for id in ids if id not in found]
+
+        rows = []
+        if self._cache_size:
+            cached = self._cached_rows(table, ids)
+            rows.extend(cached.values())
+            ids = [id for id in ids if id not in cached]
+
+        ids = list(ids)
+        for start in range(0, len(ids), MAX_VARIABLES):
+            chunk = ids[start:start + MAX_VARIABLES]
+            # pad to a power of two so a handful of statements serve every chunk size
+            size = min(1 << (len(chunk) - 1).bit_length(), MAX_VARIABLES)
+            chunk += chunk[-1:] * (size - len(chunk))
+            query = table._schema.select_by_ids_sql(size)
+            fetched = self._execute(query, chunk).fetchall()
+            if self._cache_size:
+                self._cache_rows(table, fetched)
+            rows.extend(fetched)
+
+        instances = self._build(table, rows)
+        for instance in instances:
+            instance._repr_mode = "get"
+
+        found.update((instance.id, instance) for instance in instances)
+        return found
+
+    def _prefetch(self, table, instances, names, eager=True, lazy=False):
+        """Attach the children of every instance for each reverse relation in ``names``, one IN (...) query each."""
+        related = table._schema.related
+        parents = {instance.id: instance for instance in instances}
+        ids = list(parents)
+
+        for name in names:
+            if name not in related:
+                raise ValueError(f"{table.__name__} has no reverse relation {name!r}")
+
+            child, field = related[name]
+            schema = child._schema
+            index = schema.positions[field]
+            groups = {id: [] for id in ids}
+
+            for start in range(0, len(ids), MAX_VARIABLES):
+                chunk = ids[start:start + MAX_VARIABLES]
+                size = min(1 << (len(chunk) - 1).bit_length(), MAX_VARIABLES)
+                chunk += chunk[-1:] * (size - len(chunk))
+                rows = self._execute(schema.select_by_parents_sql(field, size), chunk).fetchall()
+
+                for row, instance in zip(rows, self._build(child, rows, eager, skip=(field,), lazy=lazy)):
+                    instance._values[index] = parents[row[index]]
+                    groups[row[index]].append(instance)
+
+            for id, children in groups.items():
+                parent = parents[id]
+                if getattr(parent, "_prefetched", None) is None:
+                    parent._prefetched = {}
+                parent._prefetched[name] = children
+
+    @reads
+    def related(self, instance, name, eager=True, lazy=False):
+        """Children of one instance through the reverse relation ``name``; they stay attached to it."""
+        self._prefetch(type(instance), [instance], [name], eager, lazy)
+        return instance._prefetched[name]
+
+    @writes
     def update(self, instance):
+        if not instance._dirty:
+            return  # nothing changed since the last load or save
+
         query, values = instance._get_update_sql()
-        self.conn.execute(query, values)
-        self.conn.commit()
+        with self._autocommitted():
+            self._execute(query, values)
+        instance._dirty = 0
+        # the session keeps this very instance; only the cached row is stale
+        self._uncache(type(instance), instance.id)
 
+    @writes
     def delete(self, table, id):
-        query = table._get_delete_sql(id)
-        self.conn.execute(query)
-        self.conn.commit()
+        query = table._get_delete_sql()
+        with self._autocommitted():
+            self._execute(query, (id,))
+        self._forget(table, id)
+
+    @writes
+    def update_where(self, table, values, **predicates):
+        """Set ``values`` on every row matching the filters in one statement; returns the row count."""
+        if not values:
+            raise ValueError("update_where needs at least one field to set")
+
+        schema = table._schema
+        assignments = []
+        params = []
+        for name, value in values.items():
+            assignments.append(f"{resolve_field(schema, name)} = ?")
+            params.append(value.id if hasattr(value, "id") and not isinstance(value, (str, bytes)) else value)
+
+        query = f"UPDATE {schema.name} SET {', '.join(assignments)}"
+        return self._write_where(table, query, params, predicates)
+
+    @writes
+    def delete_where(self, table, **predicates):
+        """Delete every row matching the filters (e.g. ``id__in=[...]``); returns the row count."""
+        return self._write_where(table, f"DELETE FROM {table._schema.name}", [], predicates)
+
+    def _write_where(self, table, statement, params, predicates):
+        # generators can only be read once, and have no len()
+        predicates = {key: list(value) if key.endswith("__in") else value for key, value in predicates.items()}
+
+        # an IN (...) list longer than SQLite's variable limit is split across statements
+        batches = [predicates]
+        for key, value in predicates.items():
+            if key.endswith("__in") and len(value) > MAX_VARIABLES // 2:
+                size = MAX_VARIABLES // 2
+                batches = [{**predicates, key: value[start:start + size]} for start in range(0, len(value), size)]
+                break
+
+        count = 0
+        with self.transaction():
+            for batch in batches:
+                clauses, where_params = compile_filters(table._schema, batch)
+                where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+                count += self._execute(f"{statement}{where};", params + where_params).rowcount
+
+        self._forget_table(table)
+        return count
+
+
+class Schema:
+    """Column layout and statement text of a Table subclass, built once per class."""
+
+    CREATE_TABLE_SQL = "CREATE TABLE IF NOT EXISTS {name} ({fields});"
+    SELECT_SQL = "SELECT {fields} FROM {name}"
+    INSERT_SQL = "INSERT INTO {name} ({fields}) VALUES ({placeholders});"
+    UPDATE_SQL = "UPDATE {name} SET {assignments} WHERE id = ?;"
+    DELETE_SQL = "DELETE FROM {name} WHERE id = ?;"
+    CREATE_INDEX_SQL = "CREATE {kind} IF NOT EXISTS {index} ON {name} ({fields});"
 
+    def __init__(self, table):
+        self.table = table
+        self.name = table.__name__.lower()
 
-class Table:
-    def __init__(self, **kwargs):
-        self._data = {"id": None}
+        self.columns = []
+        self.foreign_keys = []
+        # (row index, is foreign key) for every field after id
+        self._writable = []
 
-        # always include id
+        # attribute names, their SQL column names and default values, in row order
+        self.attrs = ["id"]
+        self.fields = ["id"]
+        self.defaults = [None]
+        self.typecodes = ["q"]
+        definitions = ["id INTEGER PRIMARY KEY AUTOINCREMENT"]
 
-        # include all Column and ForeignKey fields
-        for name, col in inspect.getmembers(self.__class__):
+        for name, col in inspect.getmembers(table):
             if isinstance(col, Column):
-                self._data[name] = col.value
+                self.columns.append((name, col))
+                self._writable.append((len(self.attrs), False))
+                self.attrs.append(name)
+                self.fields.append(name)
+                self.defaults.append(col.value)
+                self.typecodes.append(TYPECODES.get(col.sql_type))
+                definitions.append(f"{name} {col.sql_type}")
             elif isinstance(col, ForeignKey):
-                self._data[name] = None
-
-        # apply user-provided values
-        for key, value in kwargs.items():
-            self._data[key] = value
-
-    @classmethod
-    def _get_create_sql(cls):
-        CREATE_TABLE_SQL = "CREATE TABLE IF NOT EXISTS {name} ({fields});"
-        fields = [
-            "id INTEGER PRIMARY KEY AUTOINCREMENT"
-
+                self.foreign_keys.append((name, col))
+                self._writable.append((len(self.attrs), True))
+                self.attrs.append(name)
+                self.fields.append(f"{name}_id")
+                self.defaults.append(None)
+                self.typecodes.append("q")
+                definitions.append(f"{name}_id INTEGER")
+
+        self.positions = {name: index for index, name in enumerate(self.attrs)}
+
+        writable_fields = self.fields[1:]
+
+        self.create_sql = self.CREATE_TABLE_SQL.format(name=self.name, fields=", ".join(definitions))
+        self.select_sql = self.SELECT_SQL.format(name=self.name, fields=", ".join(self.fields))
+        self.select_all_sql = f"{self.select_sql};"
+        self.select_by_id_sql = f"{self.select_sql} WHERE id = ?;"
+        self.select_by_field_sql = f"{self.select_sql} WHERE {{field_name}} LIKE ?;"
+        self.insert_sql = self.INSERT_SQL.format(
+            name=self.name,
+            fields=", ".join(writable_fields),
+            placeholders=", ".join("?" for _ in writable_fields),
+        )
+        self.update_sql = self.UPDATE_SQL.format(
+            name=self.name,
+            assignments=", ".join(f"{field} = ?" for field in writable_fields),
+        )
+        self.delete_sql = self.DELETE_SQL.format(name=self.name)
+        self._joins = {}
+        self._updates = {}
+        self._upserts = {}
+        # reverse accessor name -> (child table, ForeignKey attribute), filled in by the child tables
+        self.related = {}
+
+        self.searchable = [name for name, col in self.columns if col.searchable]
+        self.search_sql = self._search_sql() if self.searchable else []
+
+        indexes = [Index(name, unique=col.unique) for name, col in self.columns if col.index or col.unique]
+        indexes += [Index(name) for name, fk in self.foreign_keys if fk.index]
+        indexes += getattr(table, "__indexes__", [])
+        self.index_sql = [self._index_sql(index) for index in indexes]
+
+    def _search_sql(self):
+        """FTS5 table over the searchable columns, kept in sync with the table by triggers."""
+        name, fts = self.name, f"{self.name}_fts"
+        fields = ", ".join(self.searchable)
+        new = ", ".join(f"new.{field}" for field in self.searchable)
+        old = ", ".join(f"old.{field}" for field in self.searchable)
+        insert = f"INSERT INTO {fts} (rowid, {fields}) VALUES (new.id, {new});"
+        delete = f"INSERT INTO {fts} ({fts}, rowid, {fields}) VALUES ('delete', old.id, {old});"
+        return [
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5({fields}, content='{name}', content_rowid='id');",
+            f"CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON {name} BEGIN {insert} END;",
+            f"CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON {name} BEGIN {delete} END;",
+            f"CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE OF {fields} ON {name} BEGIN {delete} {insert} END;",
         ]
 
-        for name, col in inspect.getmembers(cls):
-            if isinstance(col, Column):
-                fields.append(f"{name} {col.sql_type}")
-
-            elif isinstance(col, ForeignKey):
-                fields.append(f"{name}_id INTEGER")
-
-        fields = ', '.join(fields)
-        name = cls.__name__.lower()
-
-        return CREATE_TABLE_SQL.format(name=name, fields=fields)
-
-    def __getattribute__(self, attr_name):
-        _data = super().__getattribute__("_data")
-
-        if attr_name in _data:
-            return _data[attr_name]
-
-        return super().__getattribute__(attr_name)
-
-    # overwrite setattr method
-    def __setattr__(self, name, value):
-        super().__setattr__(name, value)
-        if name in self._data:
-            self._data[name] = value
-
-    def _get_insert_sql(self):
-        INSERT_SQL = "INSERT INTO {name} ({fields}) VALUES ({placeholders});"
-        cls = self.__class__
+    def _index_sql(self, index):
+        foreign_keys = dict(self.foreign_keys)
         fields = []
-        placeholders = []
+        for name in index.fields:
+            if name in foreign_keys:
+                name = f"{name}_id"
+            if name not in self.fields:
+                raise ValueError(f"{self.table.__name__} has no field {name!r} to index")
+            fields.append(name)
+
+        kind = "UNIQUE INDEX" if index.unique else "INDEX"
+        name = index.name or f"{'ux' if index.unique else 'ix'}_{self.name}_{'_'.join(fields)}"
+        return self.CREATE_INDEX_SQL.format(kind=kind, index=name, name=self.name, fields=", ".join(fields))
+
+    def select_by_ids_sql(self, count):
+        return f"{self.select_sql} WHERE id IN ({', '.join('?' * count)});"
+
+    def upsert_sql(self, conflict_on, returning=True):
+        """INSERT ... ON CONFLICT DO UPDATE statement and the positions of the conflict fields in its values."""
+        if not UPSERT:
+            raise RuntimeError(f"upsert needs SQLite 3.24.0 or newer, not {sqlite3.sqlite_version}")
+
+        if (conflict_on, returning) not in self._upserts:
+            fields = [resolve_field(self, name) for name in conflict_on]
+            if not fields or "id" in fields:
+                raise ValueError("conflict_on needs one or more fields other than id, covered by a unique index")
+
+            writable = self.fields[1:]
+            # updating a conflict field to itself keeps RETURNING working when nothing else is writable
+            updates = [field for field in writable if field not in fields] or fields
+            assignments = ", ".join(f"{field} = excluded.{field}" for field in updates)
+            query = f"{self.insert_sql[:-1]} ON CONFLICT ({', '.join(fields)}) DO UPDATE SET {assignments}"
+            query += " RETURNING id;" if returning else ";"
+            self._upserts[(conflict_on, returning)] = (query, [writable.index(field) for field in fields])
+
+        return self._upserts[(conflict_on, returning)]
+
+    def select_by_keys_sql(self, conflict_on, count):
+        fields = [resolve_field(self, name) for name in conflict_on]
+        row = f"({', '.join('?' * len(fields))})"
+        return (f"SELECT id, {', '.join(fields)} FROM {self.name} "
+                f"WHERE ({', '.join(fields)}) IN (VALUES {', '.join([row] * count)});")
+
+    def select_by_parents_sql(self, field, count):
+        return f"{self.select_sql} WHERE {field}_id IN ({', '.join('?' * count)}) ORDER BY id;"
+
+    def joined(self, names):
+        """SELECT with a LEFT JOIN per foreign key in ``names`` and each joined table's slice of the row."""
+        key = tuple(names)
+        if key not in self._joins:
+            foreign_keys = dict(self.foreign_keys)
+            fields = [f"t0.{field}" for field in self.fields]
+            clauses = [f"{self.name} AS t0"]
+            joins = []
+
+            for number, name in enumerate(key, start=1):
+                if name not in foreign_keys:
+                    raise ValueError(f"{self.table.__name__}.{name} is not a ForeignKey")
+
+                target = foreign_keys[name].table
+                alias = f"t{number}"
+                joins.append((name, target, len(fields), len(fields) + len(target._schema.fields)))
+                fields.extend(f"{alias}.{field}" for field in target._schema.fields)
+                clauses.append(f"LEFT JOIN {target._schema.name} AS {alias} ON {alias}.id = t0.{name}_id")
+
+            self._joins[key] = (f"SELECT {', '.join(fields)} FROM {' '.join(clauses)}", joins)
+
+        return self._joins[key]
+
+    def update_for(self, changed):
+        """UPDATE statement and its (row index, is foreign key) list for the fields set in the ``changed`` bitmask."""
+        if changed not in self._updates:
+            writable = [(index, is_fk) for index, is_fk in self._writable if changed >> index & 1]
+            assignments = ", ".join(f"{self.fields[index]} = ?" for index, _ in writable)
+            self._updates[changed] = (self.UPDATE_SQL.format(name=self.name, assignments=assignments), writable)
+
+        return self._updates[changed]
+
+    def values(self, row, writable=None):
+        """Values for the INSERT/UPDATE placeholders, foreign keys reduced to their id."""
         values = []
+        for index, is_fk in self._writable if writable is None else writable:
+            value = row[index]
+            if is_fk:
+                value = value.id if value is not None else None
+            elif isinstance(value, Column):
+                value = None
+            values.append(value)
+        return values
+
+
+class TableMeta(type):
+    def __new__(mcs, name, bases, namespace, **kwargs):
+        # fields live in Table._values, so subclasses need no per-instance __dict__
+        namespace.setdefault("__slots__", ())
+        return super().__new__(mcs, name, bases, namespace, **kwargs)
+
+
+class Table(metaclass=TableMeta):
+    # _dirty is a bitmask of the row positions assigned since the last load or save
+    __slots__ = ("_values", "_dirty", "_repr_mode", "_prefetched")
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._schema = schema = Schema(cls)
+
+        declared = dict(schema.columns + schema.foreign_keys)
+        for index, name in enumerate(schema.attrs):
+            setattr(cls, name, Field(index, declared.get(name)))
+
+        # check every accessor before adding any, so a rejected class leaves its parents untouched
+        accessors = {}
+        for name, fk in schema.foreign_keys:
+            target = fk.table
+            related_name = fk.related_name or f"{schema.name}_set"
+            existing = target.__dict__.get(related_name)
+            # redefining the same child class (e.g. on reload) takes the accessor over; another ForeignKey
+            # of this very class to the same parent needs its own related_name
+            redefined = (isinstance(existing, Related) and existing.table is not cls
+                         and existing.table.__qualname__ == cls.__qualname__
+                         and existing.table.__module__ == cls.__module__)
+            if (existing is not None and not redefined) or (target, related_name) in accessors:
+                raise ValueError(f"{target.__name__}.{related_name} already exists; "
+                                 f"set related_name on {cls.__name__}.{name}")
+            accessors[(target, related_name)] = name
+
+        for (target, related_name), name in accessors.items():
+            setattr(target, related_name, Related(cls, name, related_name))
+            target._schema.related[related_name] = (cls, name)
 
-        for name, col in inspect.getmembers(cls):
-            value = getattr(self, name)
-
-            if isinstance(col, Column):
-                fields.append(name)
-                if not isinstance(value, Column):
-                    values.append(value)
-                else:
-                    values.append(None)
-                placeholders.append("?")
-            elif isinstance(col, ForeignKey):
-                fields.append(f"{name}_id")
-                values.append(value.id)
-                placeholders.append("?")
-
-        fields = ", ".join(fields)
-        placeholders = ", ".join(placeholders)
-
-        query = INSERT_SQL.format(name=cls.__name__.lower(), fields=fields, placeholders=placeholders)
+    def __init__(self, **kwargs):
+        # always include id, then every Column and ForeignKey field
+        self._values = list(type(self)._schema.defaults)
+        self._dirty = 0
 
-        return query, values
+        # apply user-provided values
+        for key, value in kwargs.items():
+            setattr(self, key, value)
 
     @classmethod
-    def _get_select_all_sql(cls):
-        SELECT_ALL_SQL = "SELECT {fields} FROM {name};"
+    def _from_row(cls, row):
+        instance = cls.__new__(cls)
+        instance._values = list(row)
+        instance._dirty = 0
+        return instance
 
-        fields = ["id"]
+    @classmethod
+    def _get_create_sql(cls):
+        return cls._schema.create_sql
 
-        for name, col in inspect.getmembers(cls):
-            if isinstance(col, Column):
-                fields.append(name)
-            elif isinstance(col, ForeignKey):
-                fields.append(f"{name}_id")
-        query = SELECT_ALL_SQL.format(name=cls.__name__.lower(), fields=", ".join(fields))
+    @property
+    def _data(self):
+        return RowData(self)
 
-        return query, fields
+    def _get_insert_sql(self):
+        schema = self._schema
+        return schema.insert_sql, schema.values(self._values)
 
     @classmethod
-    def _get_select_by_id_sql(cls, id):
-        SELECT_GET_SQL = "SELECT {fields} FROM {name} WHERE id = {id};"
-        fields = ["id"]
-
-        for name, col in inspect.getmembers(cls):
-            if isinstance(col, Column):
-                fields.append(name)
-            elif isinstance(col, ForeignKey):
-                fields.append(f"{name}_id")
-
-        query = SELECT_GET_SQL.format(name=cls.__name__.lower(), fields=", ".join(fields), id=id)
+    def _get_select_all_sql(cls):
+        schema = cls._schema
+        return schema.select_all_sql, schema.fields
 
-        return query, fields
+    @classmethod
+    def _get_select_by_id_sql(cls):
+        schema = cls._schema
+        return schema.select_by_id_sql, schema.fields
 
     @classmethod
     def _get_select_by_field_sql(cls, field_name, value):
-        SELECT_GET_SQL_BY_FIELD = "SELECT {fields} FROM {name} WHERE {field_name} LIKE ?;"
-
-        fields = ["id"]
-
-        for name, col in inspect.getmembers(cls):
-            if isinstance(col, Column):
-                fields.append(name)
-            elif isinstance(col, ForeignKey):
-                fields.append(f"{name}_id")
-
-        query = SELECT_GET_SQL_BY_FIELD.format(name=cls.__name__.lower(), fields=", ".join(fields),
-                                               field_name=field_name)
-
-        return query, fields
+        schema = cls._schema
+        return schema.select_by_field_sql.format(field_name=field_name), schema.fields
 
     @classmethod
     def _get_select_by_user_sql(cls, field_name, return_fields=None):
@@ -241,34 +1378,23 @@ class Table:
         else:
             fields_str = ", ".join(return_fields)
 
-        query = f"SELECT {fields_str} FROM {cls.__name__.lower()} WHERE {field_name} = ?"
+        query = f"SELECT {fields_str} FROM {cls._schema.name} WHERE {field_name} = ?"
         return query
 
-    def _get_update_sql(self):
-        fields = []
-        values = []
-
-        for name, col in inspect.getmembers(self.__class__):
-            if isinstance(col, Column):
-                fields.append(name)
-                values.append(getattr(self, name))
-            elif isinstance(col, ForeignKey):
-                fk = getattr(self, name)
-                fields.append(f"{name}_id")
-                values.append(fk.id if fk else None)
-
-        query = f"UPDATE {self.__class__.__name__.lower()} SET {', '.join([f'{field} = ?' for field in fields])} WHERE id = ?;"
+    def _get_update_sql(self, changed_only=True):
+        schema = self._schema
+        if changed_only and self._dirty & ~1:
+            query, writable = schema.update_for(self._dirty & ~1)  # id itself is never SET
+            values = schema.values(self._values, writable)
+        else:
+            query, values = schema.update_sql, schema.values(self._values)
         values.append(self.id)
 
         return query, values
 
     @classmethod
-    def _get_delete_sql(cls, id):
-        DELETE_SQL = "DELETE FROM {name} WHERE id = {id};"
-
-        query = DELETE_SQL.format(name=cls.__name__.lower(), id=id)
-
-        return query
+    def _get_delete_sql(cls):
+        return cls._schema.delete_sql
 
     def __repr__(self):
         mode = getattr(self, "_repr_mode", "default")
@@ -299,10 +1425,80 @@ class Table:
     __str__ = __repr__
 
 
+class Field:
+    """Reads and writes one slot of an instance's row; on the class it gives back the Column or ForeignKey."""
+
+    __slots__ = ("index", "column")
+
+    def __init__(self, index, column=None):
+        self.index = index
+        self.column = column
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self if self.column is None else self.column
+        return instance._values[self.index]
+
+    def __set__(self, instance, value):
+        instance._values[self.index] = value
+        instance._dirty |= 1 << self.index
+
+
+class Related:
+    """Reverse side of a ForeignKey: the child rows loaded with prefetch_related or Database.related."""
+
+    __slots__ = ("table", "field", "name")
+
+    def __init__(self, table, field, name):
+        self.table = table
+        self.field = field
+        self.name = name
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        prefetched = getattr(instance, "_prefetched", None)
+        if prefetched is None or self.name not in prefetched:
+            raise AttributeError(f"{self.name} is not loaded; use prefetch_related=[{self.name!r}] "
+                                 f"or db.related(instance, {self.name!r})")
+        return prefetched[self.name]
+
+
+class RowData(MutableMapping):
+    """Dict view of an instance's fields, writing through to the instance."""
+
+    __slots__ = ("_instance",)
+
+    def __init__(self, instance):
+        self._instance = instance
+
+    def __getitem__(self, name):
+        instance = self._instance
+        return instance._values[instance._schema.positions[name]]
+
+    def __setitem__(self, name, value):
+        instance = self._instance
+        index = instance._schema.positions[name]
+        instance._values[index] = value
+        instance._dirty |= 1 << index
+
+    def __delitem__(self, name):
+        raise TypeError("Table fields can't be removed")
+
+    def __iter__(self):
+        return iter(self._instance._schema.attrs)
+
+    def __len__(self):
+        return len(self._instance._values)
+
+
 class Column:
-    def __init__(self, column_type, default=None):
+    def __init__(self, column_type, default=None, index=False, unique=False, searchable=False):
         self.type = column_type
         self.value = default
+        self.index = index
+        self.unique = unique
+        self.searchable = searchable
 
     @property
     def sql_type(self):
@@ -318,5 +1514,47 @@ class Column:
 
 
 class ForeignKey:
-    def __init__(self, table):
+    def __init__(self, table, lazy=False, index=True, related_name=None):
         self.table = table
+        self.lazy = lazy
+        self.index = index
+        self.related_name = related_name
+
+
+class Index:
+    """Composite index for a Table's ``__indexes__`` list, e.g. ``Index("author", "published")``."""
+
+    def __init__(self, *fields, unique=False, name=None):
+        self.fields = fields
+        self.unique = unique
+        self.name = name
+
+
+class LazyReference:
+    """Stands in for a foreign-key row until one of its fields other than ``id`` is read."""
+
+    __slots__ = ("id", "_db", "_table", "_instance")
+
+    def __init__(self, db, table, id):
+        object.__setattr__(self, "id", id)
+        object.__setattr__(self, "_db", db)
+        object.__setattr__(self, "_table", table)
+        object.__setattr__(self, "_instance", None)
+
+    def _load(self):
+        if self._instance is None:
+            object.__setattr__(self, "_instance", self._db.get(self._table, id=self.id))
+        return self._instance
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._load(), name, value)
+
+    def __repr__(self):
+        if self._instance is None:
+            return f"<{self._table.__name__} id={self.id!r} (not loaded)>"
+        return repr(self._instance)
+
+    __str__ = __repr__
@@ -0,0 +1,85 @@
+import queue
+import threading
+import time
+from collections import namedtuple
+
+PoolInfo = namedtuple(
+    "PoolInfo",
+    ["size", "open", "idle", "checkouts", "waits", "wait_time", "writer_checkouts", "writer_wait_time"],
+)
+
+
+class ConnectionPool:
+    """Bounded set of reader connections, opened on demand and handed out one thread at a time."""
+
+    def __init__(self, connect, size, timeout=None):
+        if size < 1:
+            raise ValueError("pool_size must be at least 1")
+
+        self.size = size
+        self.timeout = timeout
+        self._connect = connect
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._open = []
+
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+
+    def acquire(self):
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = self._open_or_wait()
+
+        with self._lock:
+            self.checkouts += 1
+        return conn
+
+    def _open_or_wait(self):
+        with self._lock:
+            grow = len(self._open) < self.size
+            if grow:
+                self._open.append(None)  # reserve the slot before connecting outside the lock
+
+        if grow:
+            try:
+                conn = self._connect()
+            except BaseException:
+                with self._lock:
+                    self._open.remove(None)
+                raise
+            with self._lock:
+                self._open[self._open.index(None)] = conn
+            return conn
+
+        started = time.perf_counter()
+        try:
+            conn = self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise TimeoutError(f"No pooled connection became free within {self.timeout}s") from None
+
+        with self._lock:
+            self.waits += 1
+            self.wait_time += time.perf_counter() - started
+        return conn
+
+    def release(self, conn):
+        self._idle.put(conn)
+
+    @property
+    def open(self):
+        return sum(conn is not None for conn in self._open)
+
+    @property
+    def idle(self):
+        return self._idle.qsize()
+
+    def close(self):
+        with self._lock:
+            connections, self._open = self._open, []
+        for conn in connections:
+            if conn is not None:
+                conn.close()
+        self._idle = queue.LifoQueue()
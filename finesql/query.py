@@ -0,0 +1,163 @@
+LOOKUPS = {
+    "exact": "{field} = ?",
+    "ne": "{field} != ?",
+    "lt": "{field} < ?",
+    "lte": "{field} <= ?",
+    "gt": "{field} > ?",
+    "gte": "{field} >= ?",
+    "like": "{field} LIKE ?",
+    "contains": "{field} LIKE ?",
+    "startswith": "{field} LIKE ?",
+}
+
+
+def resolve_field(schema, name):
+    """SQL column for an attribute name (``author`` -> ``author_id``) or a column name."""
+    if name in schema.positions:
+        return schema.fields[schema.positions[name]]
+    if name in schema.fields:
+        return name
+    raise ValueError(f"{schema.table.__name__} has no field {name!r}")
+
+
+def compile_filters(schema, filters, alias=None):
+    """Turn ``field__lookup=value`` keyword filters into WHERE clauses and their parameters."""
+    clauses = []
+    params = []
+    prefix = f"{alias}." if alias else ""
+
+    for key, value in filters.items():
+        name, _, lookup = key.partition("__")
+        field = prefix + resolve_field(schema, name)
+        lookup = lookup or "exact"
+
+        if hasattr(value, "id") and not isinstance(value, (str, bytes)):
+            value = value.id  # a related instance stands for its id
+        if lookup == "in":
+            values = [item.id if hasattr(item, "id") else item for item in value]
+            if not values:
+                clauses.append("0")
+                continue
+            clauses.append(f"{field} IN ({', '.join('?' * len(values))})")
+            params.extend(values)
+        elif lookup == "isnull":
+            clauses.append(f"{field} IS NULL" if value else f"{field} IS NOT NULL")
+        elif value is None and lookup in ("exact", "ne"):
+            clauses.append(f"{field} IS NULL" if lookup == "exact" else f"{field} IS NOT NULL")
+        elif lookup in LOOKUPS:
+            if lookup == "contains":
+                value = f"%{value}%"
+            elif lookup == "startswith":
+                value = f"{value}%"
+            clauses.append(LOOKUPS[lookup].format(field=field))
+            params.append(value)
+        else:
+            raise ValueError(f"Unsupported lookup {lookup!r} in {key!r}")
+
+    return clauses, params
+
+
+def compile_order(schema, fields, alias=None):
+    prefix = f"{alias}." if alias else ""
+    terms = []
+    for name in fields:
+        direction = "DESC" if name.startswith("-") else "ASC"
+        terms.append(f"{prefix}{resolve_field(schema, name.lstrip('-'))} {direction}")
+    return terms
+
+
+class Query:
+    """Lazy SELECT built by chaining; nothing runs until the query is iterated."""
+
+    def __init__(self, db, table, eager=True, select_related=None, lazy=False, prefetch_related=None):
+        self.db = db
+        self.table = table
+        self.eager = eager
+        self.related = tuple(select_related or ())
+        self.lazy = lazy
+        self.prefetch = tuple(prefetch_related or ())
+        self._filters = {}
+        self._order = ()
+        self._limit = None
+        self._offset = None
+
+    def _clone(self, **changes):
+        query = Query.__new__(Query)
+        query.__dict__.update(self.__dict__, **changes)
+        return query
+
+    def filter(self, **filters):
+        return self._clone(_filters={**self._filters, **filters})
+
+    def order_by(self, *fields):
+        return self._clone(_order=fields)
+
+    def limit(self, count):
+        return self._clone(_limit=count)
+
+    def offset(self, count):
+        return self._clone(_offset=count)
+
+    def select_related(self, *names):
+        return self._clone(related=names)
+
+    def prefetch_related(self, *names):
+        return self._clone(prefetch=names)
+
+    def _where(self):
+        schema = self.table._schema
+        alias = "t0" if self.related else None
+        clauses, params = compile_filters(schema, self._filters, alias)
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        return where, params
+
+    def sql(self):
+        """The SELECT statement and parameters this query runs."""
+        schema = self.table._schema
+        alias = "t0" if self.related else None
+        query = schema.joined(self.related)[0] if self.related else schema.select_sql
+        where, params = self._where()
+        query += where
+
+        if self._order:
+            query += f" ORDER BY {', '.join(compile_order(schema, self._order, alias))}"
+        if self._limit is not None or self._offset is not None:
+            query += " LIMIT ? OFFSET ?"
+            params += [-1 if self._limit is None else self._limit, self._offset or 0]
+
+        return query + ";", params
+
+    def _rows_sql(self):
+        # matching rows without joins or ordering, for count() and exists()
+        schema = self.table._schema
+        clauses, params = compile_filters(schema, self._filters)
+        query = f"SELECT 1 FROM {schema.name}"
+        if clauses:
+            query += f" WHERE {' AND '.join(clauses)}"
+        if self._limit is not None or self._offset is not None:
+            query += " LIMIT ? OFFSET ?"
+            params += [-1 if self._limit is None else self._limit, self._offset or 0]
+        return query, params
+
+    def count(self):
+        query, params = self._rows_sql()
+        return self.db._scalar(f"SELECT COUNT(*) FROM ({query});", params)
+
+    def exists(self):
+        query, params = self._rows_sql()
+        return bool(self.db._scalar(f"SELECT EXISTS ({query});", params))
+
+    def __iter__(self):
+        query, params = self.sql()
+        return self.db._stream(self.table, query, params, 1000, self.eager, self.related, self.lazy, self.prefetch)
+
+    def all(self):
+        return list(self)
+
+    def first(self):
+        for instance in self.limit(1):
+            return instance
+        return None
+
+    def __repr__(self):
+        return f"<Query {self.sql()[0]}>"
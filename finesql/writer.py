@@ -0,0 +1,137 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class BackgroundWriter:
+    """Queue of writes that one thread commits in batches, one transaction per batch.
+
+    ``save``, ``update`` and ``delete`` return at once with a Future that resolves to the row id once its
+    batch is committed. A batch closes after ``max_batch_size`` writes, or ``max_latency`` seconds after its
+    first write. Each write runs in its own savepoint, so one failing write only fails its own Future.
+    """
+
+    def __init__(self, db, max_batch_size=500, max_latency=0.01):
+        if db._pool is None:
+            raise ValueError("BackgroundWriter needs a pooled Database (pool_size=...) to share it with its thread")
+        if not db.autocommit:
+            # transaction() only opens savepoints there, so the futures would resolve before anything commits
+            raise ValueError("BackgroundWriter needs a Database with autocommit=True")
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1")
+
+        self.db = db
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.batches = 0
+        self.writes = 0
+
+        self._queue = queue.Queue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="finesql-writer", daemon=True)
+        self._thread.start()
+
+    def _submit(self, operation, *args):
+        if self._closed:
+            raise RuntimeError("BackgroundWriter is closed")
+        future = Future()
+        self._queue.put((operation, args, future))
+        return future
+
+    def save(self, instance):
+        return self._submit(self._save, instance)
+
+    def update(self, instance):
+        return self._submit(self._update, instance)
+
+    def delete(self, table, id):
+        return self._submit(self._delete, table, id)
+
+    def flush(self):
+        """Block until every write submitted so far is committed."""
+        self._submit(None).result()
+
+    def close(self):
+        """Commit the queued writes and stop the writer thread."""
+        if not self._closed:
+            self._closed = True
+            self._queue.put(None)
+            self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _save(self, instance):
+        self.db.save(instance)
+        return instance.id
+
+    def _update(self, instance):
+        self.db.update(instance)
+        return instance.id
+
+    def _delete(self, table, id):
+        self.db.delete(table, id)
+        return id
+
+    def _run(self):
+        stop = False
+        while not stop:
+            item = self._queue.get()
+            if item is None:
+                break
+
+            batch = [item]
+            deadline = time.monotonic() + self.max_latency
+            while len(batch) < self.max_batch_size:
+                try:
+                    item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+
+            self._write(batch)
+
+    def _write(self, batch):
+        outcomes = []
+        try:
+            # held across the check below, so no other thread's transaction can be mistaken for this batch's
+            with self.db._writer() as conn:
+                with self.db.transaction():
+                    for operation, args, future in batch:
+                        if not future.set_running_or_notify_cancel():
+                            continue
+                        if operation is None:
+                            outcomes.append((future, None, None))
+                            continue
+
+                        try:
+                            with self.db.transaction():
+                                outcomes.append((future, operation(*args), None))
+                        except Exception as error:
+                            outcomes.append((future, None, error))
+
+                if conn.in_transaction:
+                    # the block only released a savepoint: resolving the futures would claim an uncommitted write
+                    conn.rollback()
+                    self.db.clear_cache()
+                    raise RuntimeError("The batch was not committed")
+        except Exception as error:  # BEGIN or COMMIT failed: nothing in the batch was written
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
+
+        self.batches += 1
+        self.writes += sum(operation is not None for operation, _, _ in batch)
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
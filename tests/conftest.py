@@ -38,10 +38,13 @@ def author():
 
 @pytest.fixture
 def book(author):
+    # the class body can't see the ``author`` argument once it assigns the same name
+    author_table = author
+
     class Book(Table):
         title = Column(str)
         published = Column(bool, default=False)
-        author = ForeignKey(author)
+        author = ForeignKey(author_table)
     return Book
 
 
@@ -5,6 +5,11 @@ import sqlite3
 import pytest
 from icecream import ic
 
+from finesql import Table, Column, ForeignKey, Index, QueryStats
+from finesql.orm import Database, numpy
+
+from conftest import DB_PATH
+
 # Clean storages dir before all tests
 for file in glob.glob("storages/*"):
     if os.path.isfile(file):
@@ -42,6 +47,19 @@ def test_table_creation(db, author, book):
         assert table in db.tables
 
 
+def test_table_schema_is_cached(author, book):
+    schema = book._schema
+    assert schema is book._schema
+    assert schema.name == "book"
+    assert schema.attrs == ["id", "author", "published", "title"]
+    assert schema.fields == ["id", "author_id", "published", "title"]
+    assert [name for name, _ in schema.foreign_keys] == ["author"]
+
+    assert book._get_select_all_sql() == ("SELECT id, author_id, published, title FROM book;", schema.fields)
+    assert schema.insert_sql == "INSERT INTO book (author_id, published, title) VALUES (?, ?, ?);"
+    assert schema.update_sql == "UPDATE book SET author_id = ?, published = ?, title = ? WHERE id = ?;"
+
+
 def test_table_instance_creation(db, author):
     db.create(author)
     john = author(name="John Doe", age=44)
@@ -187,4 +205,948 @@ def test_todo_app(db, todo):
     task.completed = True
     db.update(task)
     updated = db.get(todo, id=1)
-    assert bool(updated.completed)
\ No newline at end of file
+    assert bool(updated.completed)
+
+def count_queries(db):
+    queries = []
+    db.conn.set_trace_callback(queries.append)
+    return queries
+
+
+def test_all_loads_foreign_keys_in_batches(db, user, post):
+    db.create(user)
+    db.create(post)
+
+    alice = save_obj(db, user, username="alice")
+    bob = save_obj(db, user, username="bob")
+    for number in range(10):
+        save_obj(db, post, title=f"Post {number}", author=alice if number % 2 else bob)
+
+    queries = count_queries(db)
+    posts = db.all(post)
+
+    assert len(queries) == 2
+    assert [p.author.username for p in posts[:2]] == ["bob", "alice"]
+    assert posts[0].author is posts[2].author
+
+
+def test_foreign_key_chain_costs_one_query_per_level(db, user, post):
+    class Comment(Table):
+        text = Column(str)
+        entry = ForeignKey(post)
+
+    db.create(user)
+    db.create(post)
+    db.create(Comment)
+
+    alice = save_obj(db, user, username="alice")
+    for number in range(3):
+        hello = save_obj(db, post, title=f"Post {number}", author=alice)
+        save_obj(db, Comment, text="first!", entry=hello)
+        save_obj(db, Comment, text="second!", entry=hello)
+
+    queries = count_queries(db)
+    comments = db.all(Comment)
+
+    assert len(queries) == 3
+    assert {c.entry.author.username for c in comments} == {"alice"}
+
+    queries.clear()
+    comment = db.get(Comment, id=6, eager=False)
+    assert len(queries) == 3
+    assert comment.entry.title == "Post 2"
+
+
+def test_select_related_joins_foreign_keys(db, user, post):
+    db.create(user)
+    db.create(post)
+
+    alice = save_obj(db, user, username="alice")
+    save_obj(db, post, title="Hello", author=alice)
+    save_obj(db, post, title="Orphan", author=None)
+
+    queries = count_queries(db)
+    posts = db.all(post, select_related=["author"])
+    fetched = db.get(post, id=1, select_related=["author"])
+    found = db.get_by_field(post, field_name="title", value="Hell", select_related=["author"])
+
+    assert len(queries) == 3
+    assert posts[0].author.username == "alice"
+    assert posts[1].author is None
+    assert fetched.author.username == "alice"
+    assert found.author.username == "alice"
+
+    with pytest.raises(ValueError):
+        db.all(post, select_related=["title"])
+
+
+def test_save_many(db, user, post):
+    db.create(user)
+    db.create(post)
+    save_obj(db, user, username="existing")
+
+    alice = user(username="alice")
+    bob = user(username="bob")
+    posts = [post(title=f"Post {number}", author=alice if number % 2 else bob) for number in range(4)]
+
+    # children listed first: save_many still inserts the users before the posts
+    db.save_many(posts + [alice, bob])
+
+    assert (alice.id, bob.id) == (2, 3)
+    assert [p.id for p in posts] == [1, 2, 3, 4]
+    assert [p.author.username for p in db.all(post)] == ["bob", "alice", "bob", "alice"]
+
+
+def test_save_many_rolls_back_on_error(db, user, post):
+    db.create(user)
+
+    with pytest.raises(sqlite3.OperationalError):
+        db.save_many([user(username="alice"), post(title="no table yet")])
+
+    assert db.all(user) == []
+
+
+def test_transaction_commits_once(db, author):
+    db.create(author)
+
+    queries = count_queries(db)
+    with db.transaction():
+        john = save_obj(db, author, name="John Doe", age=23)
+        john.age = 24
+        db.update(john)
+        save_obj(db, author, name="Jack Ma", age=55)
+
+    assert queries.count("COMMIT") == 1
+    assert [a.age for a in db.all(author)] == [24, 55]
+
+
+def test_transaction_rolls_back_and_nests(db, author):
+    db.create(author)
+
+    with pytest.raises(ZeroDivisionError):
+        with db.transaction():
+            save_obj(db, author, name="John Doe", age=23)
+            1 / 0
+    assert db.all(author) == []
+
+    with db.transaction():
+        save_obj(db, author, name="Jack Ma", age=55)
+        with pytest.raises(ZeroDivisionError):
+            with db.transaction():
+                save_obj(db, author, name="John Doe", age=23)
+                1 / 0
+    assert [a.name for a in db.all(author)] == ["Jack Ma"]
+
+
+def test_autocommit_off_waits_for_commit(db, author):
+    db.create(author)
+    batch = Database(str(DB_PATH), autocommit=False)
+
+    save_obj(batch, author, name="John Doe", age=23)
+    with batch.transaction():
+        save_obj(batch, author, name="Jack Ma", age=55)
+    assert db.all(author) == []
+
+    batch.commit()
+    assert len(db.all(author)) == 2
+    batch.conn.close()
+
+
+def test_get_reuses_cached_statement(author):
+    db = Database(":memory:", cached_statements=16)
+    db.create(author)
+    save_obj(db, author, name="John Doe", age=44)
+    save_obj(db, author, name="Jack Ma", age=55)
+
+    before = db.statement_cache_info()
+    db.get(author, id=1)
+    db.get(author, id=2)
+    db.delete(author, id=2)
+    after = db.statement_cache_info()
+
+    assert after.maxsize == 16
+    assert after.misses - before.misses == 2
+    assert after.hits - before.hits == 1
+
+
+def test_iter_streams_in_batches(db, user, post):
+    db.create(user)
+    db.create(post)
+
+    alice = save_obj(db, user, username="alice")
+    db.save_many([post(title=f"Post {number}", author=alice) for number in range(10)])
+
+    queries = count_queries(db)
+    posts = db.iter(post, batch_size=4)
+    assert queries == []
+
+    first = next(posts)
+    assert first.title == "Post 0"
+    assert first.author.username == "alice"
+    assert len(queries) == 2
+
+    assert len(list(posts)) == 9
+    assert len(queries) == 4  # one foreign-key query per batch
+
+    matches = db.iter(post, batch_size=2, field_name="title", value="Post 1")
+    assert [p.title for p in matches] == ["Post 1"]
+
+
+def test_row_cache(user, post):
+    db = Database(":memory:", cache_size=2)
+    db.create(user)
+    db.create(post)
+
+    alice = save_obj(db, user, username="alice")
+    save_obj(db, post, title="Hello", author=alice)
+
+    queries = count_queries(db)
+    assert db.get(post, id=1).author.username == "alice"
+    assert queries == []  # both rows were cached by save()
+
+    db.clear_cache()
+    assert db.get(user, id=1).username == "alice"
+    assert db.get(post, id=1).author.username == "alice"
+    assert len(queries) == 2  # the author came from the cache
+
+    alice.username = "alice2"
+    db.update(alice)
+    assert db.get(user, id=1).username == "alice2"
+
+    db.delete(user, id=1)
+    with pytest.raises(Exception):
+        db.get(user, id=1)
+
+    info = db.cache_info()
+    assert info.maxsize == 2
+    assert info.currsize <= 2
+    assert info.hits == 3
+
+
+def test_session_identity_map(db, user, post):
+    db.create(user)
+    db.create(post)
+
+    alice = save_obj(db, user, username="alice")
+    save_obj(db, post, title="Hello", author=alice)
+    save_obj(db, post, title="World", author=alice)
+
+    assert db.get(user, id=1) is not db.get(user, id=1)
+
+    with db.session():
+        first = db.get(user, id=1)
+        queries = count_queries(db)
+        assert db.get(user, id=1) is first
+        assert queries == []
+
+        posts = db.all(post)
+        assert posts[0].author is first
+        assert posts[1].author is first
+        assert len(queries) == 1
+
+
+def test_lazy_foreign_keys(db, user, post):
+    db.create(user)
+    db.create(post)
+
+    alice = save_obj(db, user, username="alice")
+    save_obj(db, post, title="Hello", author=alice)
+    save_obj(db, post, title="World", author=alice)
+
+    queries = count_queries(db)
+    posts = db.all(post, lazy=True)
+    assert [p.author.id for p in posts] == [1, 1]
+    assert len(queries) == 1
+
+    assert posts[0].author.username == "alice"
+    assert posts[0].author.username == "alice"
+    assert len(queries) == 2
+
+    # the reference still saves as its id without being loaded
+    queries.clear()
+    posts[1].title = "World!"
+    db.update(posts[1])
+    assert not any(query.startswith("SELECT") for query in queries)
+
+
+def test_lazy_foreign_key_declaration(db, user):
+    class Note(Table):
+        text = Column(str)
+        owner = ForeignKey(user, lazy=True)
+
+    db.create(user)
+    db.create(Note)
+    alice = save_obj(db, user, username="alice")
+    save_obj(db, Note, text="hi", owner=alice)
+
+    note = db.get(Note, id=1)
+    assert repr(note.owner) == "<User id=1 (not loaded)>"
+    assert note.owner.username == "alice"
+
+
+def test_instances_are_slot_based(db, author):
+    john = author(name="John Doe", age=44)
+
+    assert not hasattr(john, "__dict__")
+    assert dict(john._data) == {"id": None, "age": 44, "name": "John Doe"}
+
+    john._data["age"] = 45
+    assert john.age == 45
+    john.age = 46
+    assert john._data["age"] == 46
+
+    with pytest.raises(AttributeError):
+        author(nickname="JD")
+
+
+def test_create_builds_declared_indexes(db, user):
+    class Account(Table):
+        email = Column(str, unique=True)
+        city = Column(str, index=True)
+        plan = Column(str)
+        owner = ForeignKey(user)
+        __indexes__ = [Index("city", "plan")]
+
+    db.create(user)
+    db.create(Account)
+    db.analyze()
+
+    indexes = {row[0] for row in db.conn.execute("SELECT name FROM sqlite_master WHERE type = 'index';")}
+    assert {"ux_account_email", "ix_account_city", "ix_account_owner_id", "ix_account_city_plan"} <= indexes
+
+    plan = db.conn.execute(
+        "EXPLAIN QUERY PLAN " + Account._get_select_by_user_sql(field_name="email"), ("a@b.c",)
+    ).fetchall()
+    assert "ux_account_email" in plan[0][-1]
+
+    save_obj(db, Account, email="a@b.c", city="Tashkent", plan="free", owner=None)
+    with pytest.raises(sqlite3.IntegrityError):
+        save_obj(db, Account, email="a@b.c", city="Samarkand", plan="pro", owner=None)
+
+    with pytest.raises(ValueError):
+        class Broken(Table):
+            title = Column(str)
+            __indexes__ = [Index("missing")]
+
+
+def test_query_builder(db, user, post):
+    db.create(user)
+    db.create(post)
+
+    alice = save_obj(db, user, username="alice")
+    bob = save_obj(db, user, username="bob")
+    db.save_many([post(title=f"Post {number}", author=alice if number % 3 else bob) for number in range(10)])
+
+    queries = count_queries(db)
+    recent = db.query(post).filter(author=alice, title__ne="Post 1").order_by("-id").limit(3).offset(1)
+    assert queries == []
+
+    assert [p.title for p in recent] == ["Post 7", "Post 5", "Post 4"]
+    assert queries[0] == (
+        "SELECT id, author_id, body, content, title FROM post WHERE author_id = 1 AND title != 'Post 1' "
+        "ORDER BY id DESC LIMIT 3 OFFSET 1;"
+    )
+
+    assert [p.id for p in db.query(post).filter(id__in=[2, 4, 99], author_id=1)] == [2]
+    assert db.query(post).filter(title__startswith="Post 8").first().author.username == "alice"
+    assert db.query(post).filter(title="nope").first() is None
+
+    joined = db.query(post).select_related("author").filter(author=bob).order_by("title").all()
+    assert [(p.title, p.author.username) for p in joined] == [("Post 0", "bob"), ("Post 3", "bob"),
+                                                               ("Post 6", "bob"), ("Post 9", "bob")]
+
+    with pytest.raises(ValueError):
+        db.query(post).filter(missing=1).all()
+    with pytest.raises(ValueError):
+        db.query(post).filter(title__regex="x").all()
+
+
+def test_pooled_database_is_shared_across_threads(user, post):
+    from concurrent.futures import ThreadPoolExecutor
+
+    path = DB_PATH.parent / "pooled.db"
+    for leftover in DB_PATH.parent.glob("pooled.db*"):
+        leftover.unlink()
+
+    db = Database(str(path), pool_size=2)
+    db.create(user)
+    db.create(post)
+    alice = save_obj(db, user, username="alice")
+
+    def work(number):
+        save_obj(db, post, title=f"Post {number}", author=alice)
+        return len(db.all(post))
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        counts = list(executor.map(work, range(20)))
+
+    assert len(db.all(post)) == 20
+    assert max(counts) == 20
+    assert [p.author.username for p in db.iter(post, batch_size=3)] == ["alice"] * 20
+
+    assert db.statement_cache_info() is None
+    info = db.pool_info()
+    assert info.size == 2
+    assert info.open <= 2
+    assert info.checkouts >= 20
+    assert info.writer_checkouts >= 20
+
+    db.close()
+    with pytest.raises(ValueError):
+        Database(":memory:", pool_size=2)
+    with pytest.raises(ValueError, match="autocommit"):
+        Database(str(path), pool_size=2, autocommit=False)
+
+
+def test_async_database(user, post):
+    import asyncio
+
+    from finesql import AsyncDatabase
+
+    async def main():
+        async with AsyncDatabase(":memory:") as adb:
+            await adb.create(user)
+            await adb.create(post)
+
+            alice = user(username="alice")
+            await adb.save(alice)
+            await adb.save_many([post(title=f"Post {number}", author=alice) for number in range(5)])
+
+            fetched = await asyncio.gather(*(adb.get(post, id=number) for number in range(1, 6)))
+            assert [p.author.username for p in fetched] == ["alice"] * 5
+
+            alice.username = "alice2"
+            await adb.update(alice)
+            await adb.delete(post, id=5)
+
+            titles = [p.title async for p in adb.iter(post, batch_size=2)]
+            assert titles == ["Post 0", "Post 1", "Post 2", "Post 3"]
+            assert (await adb.get(user, id=1)).username == "alice2"
+            assert len(await adb.all(post)) == 4
+
+    asyncio.run(main())
+
+
+def test_pragma_profiles(db):
+    assert db.settings()["journal_mode"] != "WAL"
+
+    fast = Database(str(DB_PATH), profile="throughput", pragmas={"busy_timeout": 1234})
+    settings = fast.settings()
+    assert settings["journal_mode"] == "WAL"
+    assert settings["synchronous"] == "NORMAL"
+    assert settings["temp_store"] == "MEMORY"
+    assert settings["cache_size"] == -65536
+    assert settings["busy_timeout"] == 1234
+    fast.close()
+
+    with pytest.raises(ValueError):
+        Database(":memory:", profile="turbo")
+
+
+def test_update_writes_only_changed_fields(db, user, post):
+    db.create(user)
+    db.create(post)
+    alice = save_obj(db, user, username="alice", age=30)
+    save_obj(db, post, title="Hello", author=alice)
+
+    fetched = db.get(post, id=1)
+    queries = count_queries(db)
+
+    db.update(fetched)
+    assert queries == []
+
+    fetched.title = "Hello again"
+    db.update(fetched)
+    assert queries[1] == "UPDATE post SET title = 'Hello again' WHERE id = 1;"
+
+    queries.clear()
+    db.update(fetched)
+    assert queries == []
+
+    fetched.author = save_obj(db, user, username="bob")
+    fetched._data["body"] = "text"
+    queries.clear()
+    db.update(fetched)
+    assert queries[1] == "UPDATE post SET author_id = 2, body = 'text' WHERE id = 1;"
+
+    assert db.get(post, id=1).author.username == "bob"
+    assert db.get(user, id=1).age == 30
+
+
+def test_update_where_and_delete_where(db, user, post):
+    db.create(user)
+    db.create(post)
+    alice = save_obj(db, user, username="alice")
+    bob = save_obj(db, user, username="bob")
+    db.save_many([post(title=f"Post {number}", author=alice if number % 2 else bob) for number in range(6)])
+
+    queries = count_queries(db)
+    assert db.update_where(post, {"author": alice, "body": "moved"}, author=bob, title__ne="Post 0") == 2
+    assert [q for q in queries if q.startswith("UPDATE")] == [
+        "UPDATE post SET author_id = 1, body = 'moved' WHERE author_id = 2 AND title != 'Post 0';"
+    ]
+    assert [p.title for p in db.query(post).filter(body="moved")] == ["Post 2", "Post 4"]
+
+    assert db.delete_where(post, id__in=[1, 2, 3, 99]) == 3
+    assert db.delete_where(post, title="nope") == 0
+    assert [p.id for p in db.all(post)] == [4, 5, 6]
+
+    with pytest.raises(ValueError):
+        db.update_where(post, {}, id=4)
+    assert db.update_where(post, {"body": "kept"}, id__in=(id for id in (4, 5))) == 2
+
+    big = list(range(4, 70000))
+    assert db.delete_where(post, id__in=big) == 3
+    assert db.delete_where(post, id__in=iter(big)) == 0
+    assert db.all(post) == []
+
+
+def test_instrumentation(db, user, post, caplog):
+    stats = QueryStats()
+    db.add_listener(after=stats)
+    db.create(user)
+    db.create(post)
+    db.remove_listener(after=stats)
+    assert stats.count("user", "CREATE") == 1
+    assert stats.count("post", "CREATE") == 2  # the table and the author_id index
+    assert {table for table, _ in stats.histograms} == {"user", "post"}
+    alice = save_obj(db, user, username="alice")
+    save_obj(db, post, title="Hello", author=alice)
+
+    before, after = [], []
+    stats = QueryStats()
+    db.add_listener(before=lambda sql, params: before.append(sql), after=after.append)
+    db.add_listener(after=stats)
+
+    db.update_where(post, {"title": "Bye"}, author=alice)
+    db.all(post)
+    assert before == [event.sql for event in after]
+    update = next(event for event in after if event.operation == "UPDATE")
+    assert (update.table, update.rowcount, update.params) == ("post", 1, ["Bye", 1])
+    assert update.duration >= 0
+    assert stats.count("post", "SELECT") == 1
+    assert stats.histograms[("post", "UPDATE")].count == 1
+    assert "post" in stats.report()
+
+    db.remove_listener(after=stats)
+    db.get(post, id=1)
+    assert stats.count() == 4
+
+    with db.assert_max_queries(1) as statements:
+        db.get(user, id=1)
+    assert statements == ["SELECT id, age, email, username FROM user WHERE id = ?;"]
+    with pytest.raises(AssertionError, match="2 queries executed"):
+        with db.assert_max_queries(1):
+            db.get(post, id=1)
+
+    db.slow_query_threshold = 0
+    with caplog.at_level("WARNING", logger="finesql"):
+        db.get_by_field(user, field_name="username", value="ali")
+    assert "slow query" in caplog.text
+    assert "SCAN user" in caplog.text
+
+
+def test_columns(db, user, post):
+    db.create(user)
+    db.create(post)
+    alice = save_obj(db, user, username="alice", age=30)
+    save_obj(db, user, username="bob", age=40)
+    db.save_many([post(title=f"Post {number}", author=alice) for number in range(3)])
+
+    queries = count_queries(db)
+    columns = db.columns(user, fields=["id", "age", "username"], batch_size=1)
+    assert len(queries) == 1
+    assert list(columns["id"]) == [1, 2]
+    assert list(columns["age"]) == [30, 40]
+    assert list(columns["username"]) == ["alice", "bob"]
+    if numpy is None:
+        assert columns["age"].typecode == "q"
+
+    assert list(db.columns(post, ["author"], where={"title__ne": "Post 0"})["author"]) == [1, 1]
+    assert list(db.columns(user, ["age"], where={"age__gt": 100})["age"]) == []
+
+    save_obj(db, user, username="carol")
+    assert list(db.columns(user, ["age"], batch_size=2)["age"]) == [30, 40, None]
+
+
+def test_aggregates(db, user, post):
+    db.create(user)
+    db.create(post)
+    alice = save_obj(db, user, username="alice", age=30)
+    bob = save_obj(db, user, username="bob", age=40)
+    save_obj(db, user, username="carol")
+    db.save_many([post(title=f"Post {number}", author=alice if number < 3 else bob) for number in range(5)])
+
+    queries = count_queries(db)
+    assert db.count(user) == 3
+    assert db.count(post, author=bob) == 2
+    assert db.exists(user, username="bob")
+    assert not db.exists(user, username="dave")
+    assert len(queries) == 4
+    assert queries[0] == "SELECT COUNT(*) FROM user;"
+
+    assert db.sum(user, "age") == 70
+    assert db.min(user, "age") == 30
+    assert db.max(user, "age", username__ne="bob") == 30
+    assert db.avg(user, "age") == 35
+    assert db.sum(user, "age", username="dave") is None
+    assert db.count(post, group_by="author") == {1: 3, 2: 2}
+    assert db.max(post, "id", group_by="author", title__ne="Post 4") == {1: 3, 2: 4}
+
+    assert db.query(post).filter(author=alice).count() == 3
+    assert db.query(post).limit(2).offset(4).count() == 1
+    assert db.query(post).filter(title="Post 4").exists()
+    assert not db.query(post).filter(title="nope").exists()
+
+
+def test_search(db):
+    class Article(Table):
+        title = Column(str, searchable=True, index=True)
+        body = Column(str, searchable=True)
+        views = Column(int)
+
+    db.create(Article)
+    db.save(Article(title="SQLite internals", body="pages and b-trees"))
+    db.conn.execute("DROP TABLE article_fts;")
+    db.create(Article)  # rebuilds the index over the rows saved without it
+    db.create(Article)
+    db.save_many([Article(title="Python tips", body="SQLite from Python"), Article(title="Gardening", body="trees")])
+
+    assert [a.title for a in db.search(Article, "title", "sqlite")] == ["SQLite internals"]
+    assert sorted(a.title for a in db.search(Article, None, "sqlite")) == ["Python tips", "SQLite internals"]
+    assert len(db.search(Article, None, "sqlite", limit=1)) == 1
+    assert db.search(Article, "title", "tree*") == []
+    assert [a.id for a in db.search(Article, "body", "tree*")] == [3, 1]  # best match first
+
+    gardening = db.get(Article, id=3)
+    gardening.title = "SQLite gardens"
+    db.update(gardening)
+    db.delete(Article, id=1)
+    assert [a.title for a in db.search(Article, "title", "sqlite")] == ["SQLite gardens"]
+
+    with pytest.raises(ValueError):
+        db.search(Article, "views", "1")
+
+    assert db.get_by_field(Article, field_name="title", value="Python tips", match="exact").id == 2
+    assert db.get_by_field(Article, field_name="title", value="Pyth", match="prefix").id == 2
+    with pytest.raises(Exception, match="not found"):
+        db.get_by_field(Article, field_name="title", value="tips", match="prefix")
+    with pytest.raises(ValueError, match="str"):
+        db.get_by_field(Article, field_name="views", value=5, match="prefix")
+
+    top = chr(0x10FFFF)
+    db.save_many([Article(title=f"a{top}x"), Article(title="b")])
+    assert db.get_by_field(Article, field_name="title", value=f"a{top}", match="prefix").title == f"a{top}x"
+    assert db._select_by_field_sql(Article, "title", top, None, "prefix")[1] == (top,)
+    with pytest.raises(Exception, match="not found"):
+        db.get_by_field(Article, field_name="title", value=top, match="prefix")
+
+    plan = db.conn.execute("EXPLAIN QUERY PLAN " + db._select_by_field_sql(Article, "title", "Py", None, "prefix")[0],
+                           ("Py", "Pz")).fetchall()
+    assert "USING INDEX" in plan[0][-1]
+
+
+def test_prefetch_related(db, author, book):
+    class Review(Table):
+        text = Column(str)
+        about = ForeignKey(book, related_name="reviews")
+
+    db.create(author)
+    db.create(book)
+    db.create(Review)
+    tolkien = save_obj(db, author, name="Tolkien")
+    save_obj(db, author, name="Nobody")
+    hobbit = save_obj(db, book, title="The Hobbit", author=tolkien)
+    save_obj(db, book, title="Silmarillion", author=tolkien)
+    db.save_many([Review(text="great", about=hobbit), Review(text="long", about=hobbit)])
+
+    queries = count_queries(db)
+    authors = db.all(author, prefetch_related=["book_set"])
+    assert len(queries) == 2
+    assert queries[1].startswith("SELECT id, author_id, published, title FROM book WHERE author_id IN (1, 2)")
+    assert [b.title for b in authors[0].book_set] == ["The Hobbit", "Silmarillion"]
+    assert authors[0].book_set[0].author is authors[0]
+    assert authors[1].book_set == []
+
+    books = db.query(book).filter(author=tolkien).prefetch_related("reviews").all()
+    assert [[r.text for r in b.reviews] for b in books] == [["great", "long"], []]
+    assert [len(b.reviews) for b in db.iter(book, batch_size=1, prefetch_related=["reviews"])] == [2, 0]
+
+    fresh = db.get(book, id=1)
+    with pytest.raises(AttributeError, match="not loaded"):
+        fresh.reviews
+    assert [r.text for r in db.related(fresh, "reviews")] == ["great", "long"]
+    assert fresh.reviews[0].about is fresh
+
+    with pytest.raises(ValueError, match="no reverse relation"):
+        db.all(author, prefetch_related=["reviews"])
+    with pytest.raises(ValueError, match="already exists"):
+        class Critique(Table):
+            about = ForeignKey(book, related_name="title")
+    with pytest.raises(ValueError, match="already exists"):
+        class Message(Table):
+            sender = ForeignKey(author)
+            recipient = ForeignKey(author)
+    assert "message_set" not in author._schema.related
+
+    class Letter(Table):
+        sender = ForeignKey(author, related_name="sent")
+        recipient = ForeignKey(author, related_name="received")
+
+    assert author._schema.related["sent"] == (Letter, "sender")
+    assert author._schema.related["received"] == (Letter, "recipient")
+
+
+def test_upsert(db, user, post):
+    class Account(Table):
+        email = Column(str, unique=True)
+        name = Column(str)
+        owner = ForeignKey(user)
+
+        __indexes__ = [Index("email", "name", unique=True)]
+
+    db.create(user)
+    db.create(Account)
+    alice = save_obj(db, user, username="alice")
+
+    first = Account(email="a@example.com", name="A", owner=alice)
+    assert db.upsert(first, conflict_on=["email"]) == 1
+    again = Account(email="a@example.com", name="A2", owner=alice)
+    queries = count_queries(db)
+    assert db.upsert(again, conflict_on=["email"]) == 1
+    assert len([q for q in queries if q.startswith("INSERT")]) == 1
+    assert again.id == 1 and db.get(Account, id=1).name == "A2"
+
+    batch = [Account(email=f"{number}@example.com", name=str(number)) for number in range(5)]
+    batch.append(Account(email="a@example.com", name="A3", owner=alice))
+    queries.clear()
+    db.upsert_many(batch, conflict_on=["email"])
+    assert queries[0] == "BEGIN"
+    assert queries[-1] == "COMMIT"
+    assert len(queries) == 9  # BEGIN, 6 upserts, one id lookup, COMMIT
+    assert batch[-1].id == 1
+    assert {account.email: account.id for account in db.all(Account)} == {a.email: a.id for a in batch}
+    assert db.get(Account, id=1).name == "A3"
+
+    db.upsert_many([Account(email="9@example.com", name="nine")], conflict_on=["email", "name"])
+    assert db.count(Account) == 7
+    with pytest.raises(ValueError):
+        db.upsert(Account(email="x"), conflict_on=["id"])
+
+    before = db.count(Account)
+    with pytest.raises(ValueError, match="conflict_on"):
+        db.upsert_many([Account(email="10@example.com", name="ten"), Account(name="no email")], ["email"])
+    assert db.count(Account) == before
+
+
+def test_upsert_without_returning(db, monkeypatch):
+    import finesql.orm
+
+    class Tag(Table):
+        label = Column(str, unique=True)
+        uses = Column(int)
+
+    monkeypatch.setattr(finesql.orm, "RETURNING", False)
+    db.create(Tag)
+    queries = count_queries(db)
+    assert db.upsert(Tag(label="sql", uses=1), conflict_on=["label"]) == 1
+    assert db.upsert(Tag(label="orm", uses=1), conflict_on=["label"]) == 2
+    assert db.upsert(Tag(label="sql", uses=2), conflict_on=["label"]) == 1
+    assert db.upsert(Tag(uses=3), conflict_on=["label"]) == 4  # the conflicting upsert used up id 3
+    assert not any("RETURNING" in query for query in queries)
+    assert db.get(Tag, id=1).uses == 2
+
+
+def test_paginate(db, user, post):
+    db.create(user)
+    db.create(post)
+    alice = save_obj(db, user, username="alice")
+    db.save_many([post(title=f"Post {number % 3}", author=alice) for number in range(7)])
+
+    pages = []
+    cursor = None
+    while True:
+        page = db.paginate(post, after=cursor, page_size=3)
+        pages.append([p.id for p in page.items])
+        if not page.has_next:
+            break
+        cursor = page.next_cursor
+    assert pages == [[1, 2, 3], [4, 5, 6], [7]]
+
+    queries = count_queries(db)
+    page = db.paginate(post, order_by="-title", page_size=4, select_related=["author"], author=alice)
+    assert [(p.title, p.id) for p in page.items] == [("Post 2", 6), ("Post 2", 3), ("Post 1", 5), ("Post 1", 2)]
+    assert page.items[0].author.username == "alice"
+    page = db.paginate(post, order_by="-title", after=page.next_cursor, page_size=4, author=alice)
+    assert [(p.title, p.id) for p in page.items] == [("Post 0", 7), ("Post 0", 4), ("Post 0", 1)]
+    assert page.next_cursor is None
+
+    assert any("WHERE author_id = 1 AND ((title, id) < ('Post 1', 2) OR title IS NULL) ORDER BY title DESC, id DESC"
+               in q for q in queries)
+
+    db.save_many([post(author=alice) for _ in range(4)])  # ids 8 to 11, without a title
+    for order_by in ("title", "-title", "-id"):
+        for page_size in (1, 3, 4, 20):
+            seen = []
+            cursor = None
+            while True:
+                page = db.paginate(post, order_by=order_by, after=cursor, page_size=page_size)
+                seen += [(p.title, p.id) for p in page.items]
+                cursor = page.next_cursor
+                if cursor is None:
+                    break
+            direction = "-" if order_by.startswith("-") else ""
+            expected = [(p.title, p.id) for p in db.query(post).order_by(order_by, direction + "id")]
+            assert seen == expected and len(seen) == 11
+
+    with pytest.raises(ValueError, match="order_by"):
+        db.paginate(post, order_by="title", after=db.paginate(post, page_size=1).next_cursor)
+    with pytest.raises(ValueError, match="Malformed"):
+        db.paginate(post, after="not a cursor")
+
+    class Blob(Table):
+        data = Column(bytes)
+
+    db.create(Blob)
+    db.save_many([Blob(data=bytes([number % 3, number])) for number in range(5)])
+    seen = []
+    cursor = None
+    while True:
+        page = db.paginate(Blob, order_by="data", after=cursor, page_size=2)
+        seen += [blob.data for blob in page.items]
+        cursor = page.next_cursor
+        if cursor is None:
+            break
+    assert seen == sorted(bytes([number % 3, number]) for number in range(5))
+
+
+def test_background_writer(user):
+    from concurrent.futures import ThreadPoolExecutor
+
+    path = DB_PATH.parent / "writer.db"
+    for leftover in DB_PATH.parent.glob("writer.db*"):
+        leftover.unlink()
+
+    db = Database(str(path), pool_size=2)
+    db.create(user)
+
+    with db.writer(max_batch_size=50, max_latency=0.05) as writer:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            futures = list(executor.map(lambda number: writer.save(user(username=f"user{number}")), range(200)))
+        ids = [future.result(timeout=5) for future in futures]
+        assert sorted(ids) == list(range(1, 201))
+        assert writer.writes == 200
+        assert writer.batches < 200
+
+        alice = db.get(user, id=ids[0])
+        alice.username = "alice"
+        assert writer.update(alice).result(timeout=5) == ids[0]
+        assert writer.delete(user, ids[1]).result(timeout=5) == ids[1]
+
+        failing = writer.update(None)
+        kept = writer.save(user(username="kept"))
+        with pytest.raises(AttributeError):
+            failing.result(timeout=5)
+        assert kept.result(timeout=5) == 201
+        writer.flush()
+
+    assert db.count(user) == 200
+    assert db.get(user, id=ids[0]).username == "alice"
+    with pytest.raises(RuntimeError):
+        writer.save(user(username="late"))
+    db.close()
+
+    with pytest.raises(ValueError):
+        Database(":memory:").writer()
+    manual = Database(str(path), pool_size=1)
+    manual.autocommit = False
+    with pytest.raises(ValueError, match="autocommit"):
+        manual.writer()
+    manual.close()
+
+
+def test_reads_inside_a_stream_reuse_its_reader(user, post):
+    path = DB_PATH.parent / "held.db"
+    for leftover in DB_PATH.parent.glob("held.db*"):
+        leftover.unlink()
+
+    db = Database(str(path), pool_size=1, pool_timeout=2)
+    db.create(user)
+    db.create(post)
+    alice = save_obj(db, user, username="alice")
+    db.save_many([post(title=f"Post {number}", author=alice) for number in range(3)])
+
+    seen = []
+    for p in db.iter(post, batch_size=1, lazy=True):
+        seen.append((db.get(user, id=1).username, p.author.username, len(db.all(post))))
+        for q in db.query(post).filter(id=p.id):
+            seen.append(q.title)
+    assert seen == [("alice", "alice", 3), "Post 0", ("alice", "alice", 3), "Post 1",
+                    ("alice", "alice", 3), "Post 2"]
+    assert db._held == {}
+    assert db.pool_info().idle == 1
+    db.close()
+
+
+def test_failed_writes_leave_no_transaction_open():
+    path = DB_PATH.parent / "stray.db"
+    for leftover in DB_PATH.parent.glob("stray.db*"):
+        leftover.unlink()
+
+    class Member(Table):
+        name = Column(str, unique=True)
+
+    db = Database(str(path), pragmas={"busy_timeout": 0})
+    db.create(Member)
+    other = sqlite3.connect(str(path), timeout=0)
+
+    db.save(Member(name="alice"))
+    with pytest.raises(sqlite3.IntegrityError):
+        db.save(Member(name="alice"))
+    assert not db.conn.in_transaction
+    with db.transaction():
+        db.save(Member(name="bob"))
+    assert not db.conn.in_transaction
+    assert other.execute("SELECT COUNT(*) FROM member;").fetchone()[0] == 2
+
+    # a reader's SHARED lock makes the COMMIT fail in rollback-journal mode
+    other.execute("BEGIN;")
+    other.execute("SELECT * FROM member;").fetchall()
+    with pytest.raises(sqlite3.OperationalError, match="locked"):
+        with db.transaction():
+            db.save(Member(name="carol"))
+    assert not db.conn.in_transaction
+    with pytest.raises(sqlite3.OperationalError, match="locked"):
+        db.save(Member(name="carol"))
+    assert not db.conn.in_transaction
+    other.rollback()
+
+    with db.transaction():
+        db.save(Member(name="dave"))
+    assert [row[0] for row in other.execute("SELECT name FROM member ORDER BY id;")] == ["alice", "bob", "dave"]
+    other.close()
+    db.close()
+
+
+def test_background_writer_fails_uncommitted_batches(user):
+    path = DB_PATH.parent / "locked.db"
+    for leftover in DB_PATH.parent.glob("locked.db*"):
+        leftover.unlink()
+
+    db = Database(str(path), pool_size=2, pragmas={"journal_mode": "DELETE", "busy_timeout": 0})
+    db.create(user)
+    other = sqlite3.connect(str(path), timeout=0)
+
+    with db.writer(max_latency=0) as writer:
+        other.execute("BEGIN;")
+        other.execute("SELECT * FROM user;").fetchall()
+        with pytest.raises(sqlite3.OperationalError, match="locked"):
+            writer.save(user(username="alice")).result(timeout=5)
+        other.rollback()
+
+        bob = writer.save(user(username="bob")).result(timeout=5)
+        assert not db.conn.in_transaction
+        assert other.execute("SELECT id, username FROM user;").fetchall() == [(bob, "bob")]
+
+    other.close()
+    db.close()